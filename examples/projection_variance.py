@@ -0,0 +1,73 @@
+import torch
+import qsketch
+import argparse
+
+
+def sw_estimate(projector_class, batch1, batch2, num_projections, key):
+    """estimate of the sliced Wasserstein distance between two batches with
+    one projector of some class"""
+    projector = projector_class(input_shape=batch1.shape[1:],
+                                num_projections=num_projections,
+                                key=key)
+    percentiles = torch.linspace(0, 100, batch1.shape[0])
+    sketch1 = qsketch.sketch.sketch(projector, batch1, percentiles)
+    sketch2 = qsketch.sketch.sketch(projector, batch2, percentiles)
+    return torch.nn.MSELoss()(sketch1, sketch2).item()
+
+
+if __name__ == "__main__":
+    """Compares the variance of the sliced Wasserstein distance estimated
+    with the different families of projectors, for an increasing number of
+    projections. The distance is computed between two batches of Gaussian
+    samples with different covariances, with independent projectors drawn
+    for each trial.
+
+    A family whose variance is lower for the same number of projections
+    gives the same gradient quality for a smaller cost per step."""
+    parser = argparse.ArgumentParser(
+        description='Variance of the sliced Wasserstein distance for several '
+                    'families of projections.')
+    parser.add_argument("--dim",
+                        help="Dimension of the samples",
+                        type=int,
+                        default=64)
+    parser.add_argument("--num_samples",
+                        help="Number of samples in each batch",
+                        type=int,
+                        default=512)
+    parser.add_argument("--num_trials",
+                        help="Number of independent estimates for each "
+                             "number of projections",
+                        type=int,
+                        default=100)
+    parser.add_argument("--num_projections",
+                        help="Numbers of projections to test",
+                        type=int,
+                        nargs='+',
+                        default=[1, 4, 16, 64, 256])
+    args = parser.parse_args()
+
+    # two batches of samples, with different covariances
+    torch.manual_seed(0)
+    batch1 = torch.randn(args.num_samples, args.dim)
+    batch2 = (torch.randn(args.num_samples, args.dim)
+              * torch.linspace(0.5, 2, args.dim))
+
+    families = [qsketch.LinearProjector,
+                qsketch.OrthogonalProjector,
+                qsketch.SobolProjector,
+                qsketch.HadamardProjector]
+    print('%16s' % 'projections'
+          + ''.join('%22s' % family.__name__ for family in families))
+    for num_projections in args.num_projections:
+        line = '%16d' % num_projections
+        for family in families:
+            estimates = torch.tensor(
+                [sw_estimate(family, batch1, batch2, num_projections,
+                             key=(0, trial))
+                 for trial in range(args.num_trials)])
+            line += '%22s' % ('%.3e (%.3e)' % (estimates.var().item(),
+                                              estimates.mean().item()))
+        print(line)
+    print('Each cell gives the variance of the estimates, with their mean '
+          'in parenthesis.')
@@ -1,4 +1,8 @@
-from .datastream import DataStream
+from .datastream import DataStream, SubsetSampler
 from .datasets import ModulesDataset, TransformedDataset
+from .summary import QuantileSummary
+from .cache import LRUCache, SketchCache, SampleCache
 from .sketch import Sketcher, add_sketch_arguments
-from .gsw import sw, GSW, LinearProjector
+from .bank import SketchBank, build_sketch_bank
+from .gsw import (sw, GSW, LinearProjector, HadamardProjector,
+                  OrthogonalProjector, SobolProjector)
@@ -0,0 +1,149 @@
+import torch
+import numpy as np
+import os
+import struct
+from pathlib import Path
+from .sketch import sketch, to_iterator
+from .cache import fingerprint
+from .datastream import loader
+
+# header of a bank file: magic, version, number of sketches, number of
+# percentiles, dimension of each sketch, fingerprint of the projectors
+HEADER = struct.Struct('<4sIQQQ40s')
+MAGIC = b'QSKB'
+VERSION = 1
+
+
+class SketchBank:
+    """A precomputed bank of sketches, memory-mapped from a file.
+
+    The sketch of index `i` is the one of the projector of index `i` in the
+    dataset of projectors used for building the bank with
+    `build_sketch_bank`. Accessing the bank only reads the corresponding
+    slice of the file, and several processes reading the same bank share it
+    through the page cache.
+
+    path: string
+        the file of the bank
+    """
+
+    def __init__(self, path):
+        self.path = str(Path(path).expanduser())
+        with open(self.path, 'rb') as file:
+            (magic, version, self.num_sketches, self.num_percentiles,
+             self.dim, projectors) = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise Exception('SketchBank: %s is not a sketch bank.'
+                                % self.path)
+            self.percentiles = torch.from_numpy(np.fromfile(
+                file, dtype=np.float32, count=self.num_percentiles))
+        projectors = projectors.rstrip(b'\0').decode()
+        self.projectors_fingerprint = projectors if projectors else None
+        self.sketches = np.memmap(
+            self.path, dtype=np.float32, mode='r',
+            offset=HEADER.size + 4 * self.num_percentiles,
+            shape=(self.num_sketches, self.num_percentiles, self.dim))
+
+    def __len__(self):
+        return self.num_sketches
+
+    def __getitem__(self, indexes):
+        """get the sketches of some indexes, as a Tensor
+        (num_percentiles, dim) for an int, or (len(indexes), num_percentiles,
+        dim) otherwise"""
+        if isinstance(indexes, torch.Tensor):
+            indexes = indexes.numpy() if indexes.dim() else indexes.item()
+        return torch.from_numpy(np.array(self.sketches[indexes]))
+
+
+def build_sketch_bank(path, projectors, data, num_sketches, percentiles,
+                      num_examples=None, error=None, chunk_size=64):
+    """Sketches the first projectors of a dataset of projectors against some
+    data, and writes the result as a SketchBank file.
+
+    path: string
+        the file to write
+    projectors: ModulesDataset
+        the projectors. Their `bank` method is used if available, so that
+        the projectors of a chunk are applied at once.
+    data: Dataset, Tensor, DataStream or any data source for `sketch`
+        the data to sketch. For a dataset, it is randomly shuffled for
+        each chunk.
+    num_sketches: int
+        the number K of projectors to sketch, from index 0 to K - 1
+    percentiles: Tensor
+        the percentiles to compute
+    num_examples: int or None
+        the number of samples to use for each sketch. If None, all data
+    error: float or None
+        the error of the quantile summaries, see `sketch`
+    chunk_size: int
+        the number of projectors sketched together, on the same data
+
+    returns the SketchBank"""
+    if num_sketches <= 0:
+        raise Exception('build_sketch_bank: the number of sketches must be '
+                        'positive.')
+    path = Path(path).expanduser()
+    percentiles = torch.as_tensor(percentiles).float()
+    random_access = (not isinstance(data, torch.Tensor)
+                     and hasattr(data, '__getitem__')
+                     and hasattr(data, '__len__'))
+    data_iterator = None
+    projectors_fingerprint = fingerprint(projectors) or ''
+    use_bank = callable(getattr(projectors, 'bank', None))
+
+    temp = path.with_name(path.name + '.%d.tmp' % os.getpid())
+    sketches = None
+    for start in range(0, num_sketches, chunk_size):
+        indexes = list(range(start, min(start + chunk_size, num_sketches)))
+        # a new iterator for each chunk, since sketching may exhaust it.
+        # The previous one is closed, so that it leaves a BatchBroadcast
+        close = getattr(data_iterator, 'close', None)
+        if callable(close):
+            close()
+        if random_access:
+            data_iterator = iter(loader(data, 600, shuffle=True))
+        else:
+            data_iterator = to_iterator(data)
+        if use_bank:
+            modules = projectors.bank(indexes)
+        else:
+            modules = projectors(indexes)
+        if isinstance(modules, torch.nn.Module):
+            # a bank: we get the quantiles of all projectors at once
+            chunk = sketch(modules, data_iterator, percentiles,
+                           num_examples=num_examples, error=error)
+            chunk = chunk.view(len(percentiles), len(indexes), -1)
+            chunk = chunk.permute(1, 0, 2)
+        else:
+            chunk = torch.stack(
+                [item.view(len(percentiles), -1) for item in
+                 sketch(modules, data_iterator, percentiles,
+                        num_examples=num_examples, error=error, fused=True)])
+
+        if sketches is None:
+            # we now know the dimension of the sketches, write the header and
+            # map the file
+            offset = HEADER.size + 4 * len(percentiles)
+            with open(str(temp), 'wb') as file:
+                file.write(HEADER.pack(MAGIC, VERSION, num_sketches,
+                                       len(percentiles), chunk.shape[-1],
+                                       projectors_fingerprint.encode()))
+                percentiles.numpy().astype(np.float32).tofile(file)
+                file.truncate(
+                    offset + 4 * num_sketches * len(percentiles)
+                    * chunk.shape[-1])
+            sketches = np.memmap(
+                str(temp), dtype=np.float32, mode='r+', offset=offset,
+                shape=(num_sketches, len(percentiles), chunk.shape[-1]))
+        sketches[indexes[0]:indexes[-1] + 1] = (
+            chunk.detach().cpu().float().numpy())
+
+    close = getattr(data_iterator, 'close', None)
+    if callable(close):
+        close()
+    sketches.flush()
+    del sketches
+    os.replace(str(temp), str(path))
+    return SketchBank(path)
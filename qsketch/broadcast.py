@@ -0,0 +1,251 @@
+import torch
+import torch.multiprocessing as mp
+import os
+import queue
+import time
+
+# the interval between two checks of a waiting producer or subscriber,
+# between two checks for dead subscribers, and the time after which the lock
+# is considered as held by a dead subscriber, in seconds
+POLL_INTERVAL = 0.001
+REAP_INTERVAL = 0.1
+LOCK_TIMEOUT = 5
+
+
+class BatchBroadcast:
+    """A ring buffer of data batches in shared memory, read by several
+    subscribers.
+
+    Contrary to a queue, where each batch goes to a single consumer, each
+    batch put in the ring is read by all the subscribers, without copy: they
+    get views on the shared memory. Each slot has a reference count, set to
+    the number of subscribers when the batch is put, and decremented when a
+    subscriber is done with it. The slot is free again when it reaches zero.
+
+    Subscribers are obtained with `subscriber`. They are iterators, which
+    only join the broadcast when first used, and must `close` when they stop
+    reading, so that they do not hold the batches. Since all subscribers
+    read all batches, the slowest one sets the pace of the producer.
+
+    As for a queue, None is accepted as a sentinel item.
+
+    Waiting is done by polling the shared state, with a lock held only for
+    short updates: contrary to a condition, this cannot be broken by a
+    subscriber that is terminated while waiting. The subscribers record
+    their process ids, and those whose process is dead, e.g. terminated
+    sketching workers, are released by the producer while it waits. If one
+    of them was killed while holding the lock, the producer releases it.
+
+    slots: int
+        the capacity of the ring
+    batch_size: int
+        the maximum number of samples of a batch
+    shapes: tuple of two tuples of int
+        the shapes of a sample and of a target
+    dtypes: tuple of two torch dtypes
+        the types of the samples and of the targets
+    max_subscribers: int
+        the maximum number of subscribers at the same time
+    device: string
+        the device to which subscribers send the batches. The ring itself is
+        always in shared CPU memory.
+    """
+
+    def __init__(self, slots, batch_size, shapes, dtypes, max_subscribers,
+                 device='cpu'):
+        self.slots = slots
+        self.device = device
+        self.X = torch.zeros((slots, batch_size) + tuple(shapes[0]),
+                             dtype=dtypes[0]).share_memory_()
+        self.Y = torch.zeros((slots, batch_size) + tuple(shapes[1]),
+                             dtype=dtypes[1]).share_memory_()
+        # number of samples in each slot, -1 for a sentinel
+        self.lengths = torch.zeros(slots, dtype=torch.int64).share_memory_()
+        self.refcounts = torch.zeros(slots, dtype=torch.int64).share_memory_()
+        # number of batches put so far
+        self.produced = torch.zeros(1, dtype=torch.int64).share_memory_()
+        # for each subscriber, whether it is active, the position of the
+        # first batch it did not release yet, and its process id
+        self.active = torch.zeros(max_subscribers,
+                                  dtype=torch.int8).share_memory_()
+        self.positions = torch.zeros(max_subscribers,
+                                     dtype=torch.int64).share_memory_()
+        self.pids = torch.zeros(max_subscribers,
+                                dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+
+    @classmethod
+    def for_dataset(cls, dataset, batch_size, max_subscribers, slots=4,
+                    device='cpu'):
+        """creates a broadcast for the batches of a dataset of (X, y)
+        items, with shapes and types of the first item"""
+        (X, y) = dataset[0]
+        (X, y) = (torch.as_tensor(X), torch.as_tensor(y))
+        return cls(slots, batch_size, (X.shape, y.shape), (X.dtype, y.dtype),
+                   max_subscribers, device)
+
+    def _slot(self, position):
+        return int(position) % self.slots
+
+    def put(self, item, block=True, timeout=None):
+        """puts a batch (X, Y), or None. It is written in place in the next
+        slot, once it has been released by all subscribers, and once there
+        is at least one of them."""
+        slot = self._slot(self.produced[0])
+        if not self._wait_for(
+                lambda: (bool(self.active.any())
+                         and int(self.refcounts[slot]) <= 0),
+                timeout if block else 0, reap=True):
+            raise queue.Full
+        # the slot can only be read once `produced` is incremented, the copy
+        # is done without holding the lock
+        if item is None:
+            self.lengths[slot] = -1
+        else:
+            (X, Y) = item
+            self.X[slot, :len(X)] = X
+            self.Y[slot, :len(Y)] = torch.as_tensor(Y).view(
+                (len(Y),) + self.Y.shape[2:])
+            self.lengths[slot] = len(X)
+        with self.lock:
+            self.refcounts[slot] = int(self.active.sum())
+            self.produced[0] += 1
+
+    def _wait_for(self, predicate, timeout=None, reap=False):
+        """waits until a predicate is true, checking it with the lock
+        acquired, and returns whether it is. If reap is True, the dead
+        subscribers are released in the meantime."""
+        deadline = None if timeout is None else time.time() + timeout
+        reaped = time.time()
+        while True:
+            if reap:
+                self._acquire()
+            else:
+                self.lock.acquire()
+            try:
+                if predicate():
+                    return True
+                if reap and time.time() - reaped > REAP_INTERVAL:
+                    self._reap()
+                    reaped = time.time()
+            finally:
+                self.lock.release()
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def _acquire(self):
+        """acquires the lock. It is only held for short updates: if it
+        cannot be acquired for a long time while some subscriber is dead,
+        this subscriber was killed while holding it, and it is released."""
+        while not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            if self._dead():
+                self.lock.release()
+
+    def _dead(self):
+        """the indexes of the active subscribers whose process is dead"""
+        dead = []
+        for index in self.active.nonzero().view(-1).tolist():
+            try:
+                os.kill(int(self.pids[index]), 0)
+            except ProcessLookupError:
+                dead += [index, ]
+            except PermissionError:
+                pass
+        return dead
+
+    def _reap(self):
+        """releases the subscribers whose process is dead. Must be called
+        with the lock acquired."""
+        for index in self._dead():
+            self._release(index, int(self.produced[0]))
+            self.active[index] = 0
+
+    def empty(self):
+        """whether all batches have been released by the subscribers"""
+        with self.lock:
+            return not self.refcounts.any()
+
+    def subscriber(self):
+        return Subscriber(self)
+
+    def _subscribe(self):
+        with self.lock:
+            free = (self.active == 0).nonzero()
+            if not len(free):
+                raise Exception('BatchBroadcast: too many subscribers.')
+            index = int(free[0])
+            self.positions[index] = self.produced[0]
+            self.pids[index] = os.getpid()
+            self.active[index] = 1
+            return index
+
+    def _release(self, index, end):
+        """releases the batches of a subscriber up to some position. Must be
+        called with the lock acquired."""
+        for position in range(int(self.positions[index]), end):
+            self.refcounts[self._slot(position)] -= 1
+        self.positions[index] = end
+
+    def _unsubscribe(self, index):
+        with self.lock:
+            if self.active[index]:
+                self._release(index, int(self.produced[0]))
+                self.active[index] = 0
+
+
+class Subscriber:
+    """Iterator over the batches of a BatchBroadcast. Each batch is a view on
+    the shared memory, which is only valid until the next one is asked for:
+    the subscriber then releases it.
+
+    A subscriber joins the broadcast when first used, and leaves it with
+    `close`. When pickled, it is sent as a new subscriber, so that each
+    process gets its own. A forked process must call `reset` instead."""
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.index = None
+        self.holding = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        broadcast = self.broadcast
+        if self.index is None:
+            self.index = broadcast._subscribe()
+        with broadcast.lock:
+            position = int(broadcast.positions[self.index])
+            # release the batch we hold, if any
+            if self.holding:
+                position += 1
+                broadcast._release(self.index, position)
+                self.holding = False
+        broadcast._wait_for(lambda: int(broadcast.produced[0]) > position)
+        slot = broadcast._slot(position)
+        length = int(broadcast.lengths[slot])
+        if length < 0:
+            with broadcast.lock:
+                broadcast._release(self.index, position + 1)
+            raise StopIteration
+        self.holding = True
+        device = torch.device(broadcast.device)
+        return (broadcast.X[slot, :length].to(device),
+                broadcast.Y[slot, :length].to(device))
+
+    def close(self):
+        """leaves the broadcast, releasing all the batches still held"""
+        if self.index is not None:
+            self.broadcast._unsubscribe(self.index)
+            self.index = None
+            self.holding = False
+
+    def reset(self):
+        """forgets the subscription inherited from the parent process,
+        without leaving it, so that this process joins as a new subscriber"""
+        self.index = None
+        self.holding = False
+
+    def __getstate__(self):
+        return {'broadcast': self.broadcast, 'index': None, 'holding': False}
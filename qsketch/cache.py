@@ -0,0 +1,420 @@
+import torch
+import numpy as np
+import atexit
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+import warnings
+from pathlib import Path
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'size', 'bytes', 'max_bytes'])
+
+
+def nbytes(value):
+    """number of bytes of the tensors in some value, which may be a Tensor
+    or a (nested) list, tuple or dict of them"""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+    return 0
+
+
+def _update(hasher, value):
+    """feed a hasher with some value, recursively"""
+    if isinstance(value, torch.Tensor):
+        hasher.update(str((value.dtype, tuple(value.shape))).encode())
+        hasher.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            hasher.update(repr(key).encode())
+            _update(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _update(hasher, item)
+    elif hasattr(value, 'tobytes'):
+        # numpy arrays, PIL images
+        hasher.update(value.tobytes())
+    else:
+        hasher.update(repr(value).encode())
+
+
+def fingerprint(obj):
+    """computes a string identifying some data: a Tensor, a dataset, or any
+    object with a `fingerprint` method. For a dataset, the fingerprint is
+    obtained from its type, its length and a few of its samples.
+    Returns None if the object cannot be identified."""
+    method = getattr(obj, 'fingerprint', None)
+    if method is not None and callable(method):
+        return method()
+    hasher = hashlib.sha1()
+    if isinstance(obj, torch.Tensor):
+        _update(hasher, obj)
+        return hasher.hexdigest()
+    if not (hasattr(obj, '__getitem__') and hasattr(obj, '__len__')):
+        return None
+    length = len(obj)
+    hasher.update(('%s.%s:%d' % (type(obj).__module__,
+                                 type(obj).__qualname__,
+                                 length)).encode())
+    for index in sorted(set([0, length // 2, length - 1])):
+        if 0 <= index < length:
+            _update(hasher, obj[index])
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """A bounded in-memory cache, with least recently used eviction.
+
+    The size of the cache is the total number of bytes of the tensors it
+    contains. Each process has its own cache: its content is not pickled.
+
+    max_bytes: int
+        the memory budget of the cache, in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.items = collections.OrderedDict()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """get an item from the cache, updating the hit and miss counters"""
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value):
+        """put an item in the cache, evicting the least recently used ones if
+        the memory budget is exceeded. Items larger than the budget are not
+        stored."""
+        size = nbytes(value)
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self.items.popitem(last=False)[1][1]
+
+    def info(self):
+        return CacheInfo(hits=self.hits, misses=self.misses,
+                         size=len(self.items), bytes=self.bytes,
+                         max_bytes=self.max_bytes)
+
+    def __getstate__(self):
+        # only the budget is pickled, the cache starts empty
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+
+class SketchCache:
+    """A cache of sketches, with an in-memory tier and an optional on-disk
+    tier.
+
+    The in-memory tier is an LRUCache. The on-disk tier stores each sketch
+    as a .npy file, which is loaded when read. It is persistent and shared
+    by all processes using the same path, so that sketches computed once,
+    e.g. by a previous training job, are reused.
+
+    The on-disk tier has its own budget. When a process finds it exceeded,
+    the least recently used files are removed, down to 3/4 of the budget.
+    Files are marked as used by updating their modification time when read.
+    Each process counts what it writes, and only scans the directory again
+    when its count exceeds the budget, so the budget is approximate when
+    several processes write at the same time.
+
+    Sketches are stored on CPU, and are hence returned on CPU.
+
+    path: string or None
+        the directory of the on-disk tier. If None, only the in-memory tier
+        is used.
+    max_bytes: int
+        the memory budget of the in-memory tier, in bytes
+    max_disk_bytes: int or None
+        the budget of the on-disk tier, in bytes. If None, it is unbounded.
+    """
+
+    def __init__(self, path=None, max_bytes=2**28, max_disk_bytes=2**33):
+        self.memory = LRUCache(max_bytes)
+        self.path = None
+        self.max_disk_bytes = max_disk_bytes
+        # the size of the on-disk tier, scanned on the first write
+        self.disk_bytes = None
+        if path is not None:
+            self.path = Path(path).expanduser()
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(projectors, index, percentiles, num_examples, error, data):
+        """computes the key of a sketch.
+
+        projectors: string
+            the fingerprint of the dataset of projectors
+        index: int
+            the index of the projector
+        percentiles: Tensor
+            the percentiles of the sketch
+        num_examples: int or None
+            the number of samples used for the sketch
+        error: float or None
+            the error of the quantile summary used for the sketch
+        data: string
+            the fingerprint of the sketched data"""
+        percentiles = torch.as_tensor(percentiles).tolist()
+        return hashlib.sha1(repr(
+            (projectors, int(index), percentiles, num_examples, error, data)
+            ).encode()).hexdigest()
+
+    def _file(self, key):
+        return self.path / (key + '.npy')
+
+    def get(self, key):
+        """returns the sketch for a key, or None if it is not cached"""
+        value = self.memory.get(key)
+        if value is not None or self.path is None:
+            return value
+        file = self._file(key)
+        try:
+            value = torch.from_numpy(np.load(str(file)))
+            # marking the file as recently used
+            os.utime(str(file))
+        except (FileNotFoundError, ValueError):
+            # missing, or being evicted by another process
+            return None
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """puts a sketch in the cache"""
+        value = value.detach().cpu()
+        self.memory.put(key, value)
+        if self.path is None:
+            return
+        # write to a temporary file first, so that concurrent readers never
+        # see partial files
+        temp = self.path / ('%s.%d.tmp' % (key, os.getpid()))
+        with open(str(temp), 'wb') as file:
+            np.save(file, value.numpy())
+        size = os.path.getsize(str(temp))
+        os.replace(str(temp), str(self._file(key)))
+        if self.max_disk_bytes is None:
+            return
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(size for (size, _, _) in self._files())
+        else:
+            self.disk_bytes += size
+        if self.disk_bytes > self.max_disk_bytes:
+            self.evict()
+
+    def _files(self):
+        """the (size, modification time, path) of the files of the on-disk
+        tier"""
+        files = []
+        for entry in os.scandir(str(self.path)):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files += [(stat.st_size, stat.st_mtime, entry.path), ]
+        return files
+
+    def evict(self):
+        """removes the least recently used files of the on-disk tier until
+        it takes less than 3/4 of its budget"""
+        files = sorted(self._files(), key=lambda file: file[1])
+        self.disk_bytes = sum(size for (size, _, _) in files)
+        for (size, _, path) in files:
+            if self.disk_bytes <= self.max_disk_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_bytes -= size
+
+    def info(self):
+        """statistics of the in-memory tier"""
+        return self.memory.info()
+
+
+class SampleCache:
+    """A cache of the samples of a dataset, addressed by their index, with an
+    in-memory tier and an optional on-disk tier.
+
+    This is meant for datasets whose samples are costly to compute and
+    deterministic, such as a TransformedDataset with a fixed feature
+    extractor. The in-memory tier is an LRUCache, private to each process.
+    The on-disk tier is a set of memory-mapped files with one record per
+    index, along with a flag telling whether it was written. It is shared by
+    all the processes that got the cache from the one that created it, e.g.
+    the workers of a DataStream.
+
+    By default, the on-disk tier only lasts for one run: it is a private
+    subdirectory of the path, removed when the process that created the
+    cache exits. It is persistent across runs if a namespace is given. The
+    fingerprint of the dataset cannot tell all changes of its transforms,
+    e.g. of the code of their `forward` method, so the namespace must then
+    be changed whenever the samples change.
+
+    A SampleCache is bound to a dataset with `bind`, with its fingerprint
+    and length: the on-disk tier is a subdirectory named after the
+    fingerprint, so that the samples of different datasets, e.g. with other
+    transforms, are never mixed. If the dataset has no fingerprint, only the
+    in-memory tier is used. The files are created by the first process
+    storing a sample, when the shapes of the samples are known.
+
+    Samples are (X, y) tuples of Tensors, stored on CPU.
+
+    path: string or None
+        the directory of the on-disk tier. If None, only the in-memory tier
+        is used.
+    max_bytes: int
+        the memory budget of the in-memory tier, in bytes
+    namespace: string or None
+        if provided, the on-disk tier is the subdirectory of the path with
+        this name, and it is persistent across runs.
+    """
+
+    def __init__(self, path=None, max_bytes=2**28, namespace=None):
+        self.memory = LRUCache(max_bytes)
+        self.path = None if path is None else Path(path).expanduser()
+        self.namespace = namespace
+        if self.path is not None and namespace is None:
+            # a directory for this run only
+            self.namespace = 'run-%d-%s' % (os.getpid(), uuid.uuid4().hex)
+            self.owner = os.getpid()
+            atexit.register(self._remove)
+        self.directory = None
+        self.length = None
+        self.files = None
+
+    def _remove(self):
+        """removes the on-disk tier of a single run, from the process that
+        created it"""
+        if os.getpid() == self.owner:
+            self.files = None
+            shutil.rmtree(str(self.path / self.namespace), ignore_errors=True)
+
+    def bind(self, fingerprint, length):
+        """binds the cache to a dataset, from its fingerprint and length.
+        If the fingerprint is None, the on-disk tier is disabled."""
+        self.length = length
+        if self.path is not None and fingerprint is None:
+            warnings.warn('SampleCache: cannot identify the dataset, '
+                          'disabling the on-disk tier.')
+        elif self.path is not None:
+            self.directory = self.path / self.namespace / fingerprint
+            self.directory.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def _open(self):
+        """maps the files of the on-disk tier, if they exist. Returns whether
+        they are mapped."""
+        if self.files is not None:
+            return True
+        store = self.directory / 'store'
+        meta = store / 'meta.json'
+        if not meta.exists():
+            return False
+        with open(str(meta)) as file:
+            meta = json.load(file)
+        self.files = {'valid': np.memmap(str(store / 'valid'),
+                                         dtype=np.uint8, mode='r+',
+                                         shape=(self.length,))}
+        for name in ('X', 'y'):
+            self.files[name] = np.memmap(
+                str(store / name), dtype=meta[name]['dtype'],
+                mode='r+', shape=(self.length,) + tuple(meta[name]['shape']))
+        return True
+
+    def _create(self, X, y):
+        """creates the files of the on-disk tier, for samples like (X, y).
+        They are written in a private temporary directory, which is then
+        renamed as the store. Renaming fails if another process did it
+        first, and its store is used instead. A process that crashes only
+        leaves a temporary directory behind."""
+        temp = self.directory / ('store.%d.tmp' % os.getpid())
+        temp.mkdir(exist_ok=True)
+        meta = {}
+        for (name, value) in (('X', X), ('y', y)):
+            value = value.numpy()
+            meta[name] = {'dtype': value.dtype.str,
+                          'shape': list(value.shape)}
+            with open(str(temp / name), 'wb') as file:
+                file.truncate(self.length * value.nbytes)
+        with open(str(temp / 'valid'), 'wb') as file:
+            file.truncate(self.length)
+        with open(str(temp / 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        try:
+            os.rename(str(temp), str(self.directory / 'store'))
+        except OSError:
+            shutil.rmtree(str(temp), ignore_errors=True)
+        return self._open()
+
+    def get(self, index):
+        """returns the sample for an index, or None if it is not cached"""
+        value = self.memory.get(index)
+        if (value is not None or self.directory is None
+                or not self._open() or not self.files['valid'][index]):
+            return value
+        value = tuple(torch.from_numpy(np.array(self.files[name][index]))
+                      for name in ('X', 'y'))
+        self.memory.put(index, value)
+        return value
+
+    def put(self, index, value):
+        """puts the sample (X, y) of an index in the cache"""
+        value = tuple(torch.as_tensor(item).detach().cpu() for item in value)
+        self.memory.put(index, value)
+        if self.directory is None:
+            return
+        if not self._open() and not self._create(*value):
+            return
+        if self.files['valid'][index]:
+            return
+        # the flag is set last, so that readers never see partial samples
+        for (name, item) in zip(('X', 'y'), value):
+            self.files[name][index] = item.numpy()
+        self.files['valid'][index] = 1
+
+    def info(self):
+        """statistics of the in-memory tier"""
+        return self.memory.info()
+
+    def __getstate__(self):
+        # the files are mapped again by each process
+        state = self.__dict__.copy()
+        state['files'] = None
+        return state
@@ -1,5 +1,22 @@
 import torch
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
 import copy
+import hashlib
+import inspect
+import threading
+import warnings
+from . import philox
+from .cache import LRUCache, SampleCache, fingerprint
+try:
+    from torch.func import vmap, functional_call, stack_module_state
+except ImportError:
+    # older versions of pytorch, StackedModules then applies the modules
+    # one after the other
+    vmap = None
+
+# lock protecting the global random state, when temporarily seeding it for
+# modules that cannot be reset with a key
+_global_rng_lock = threading.Lock()
 
 
 class ModulesDataset:
@@ -15,18 +32,32 @@ class ModulesDataset:
         accessing elements. If recycling is activated, a current element
         is kept in memory, which is reassigned new values on demand, instead
         of a new allocation.
+    seed: int
+        the seed of the dataset. Each element is generated from the
+        (seed, index) key only, without using or modifying the global random
+        state, so that it is reproducible and can be generated concurrently
+        in several threads or processes.
+    cache_size: int or None
+        if provided, the parameters of the generated modules are kept in a
+        least recently used cache with this memory budget in bytes, so that
+        accessing them again costs no generation. See `cache_info`.
     kwargs: dict
         parameters to provide to the class constructor when creating new
         elements
     """
 
-    def __init__(self, module_class, device='cpu', recycle=True, **kwargs):
+    def __init__(self, module_class, device='cpu', recycle=True, seed=0,
+                 cache_size=None, **kwargs):
         self.module_class = module_class
         self.parameters = kwargs
         self.pos = 0
         self.current = None
         self.device = device
         self.recycle = recycle
+        self.seed = seed
+        self.cache = None if cache_size is None else LRUCache(cache_size)
+        # the module copied for the cached parameters, created on demand
+        self.template = None
 
     def __iter__(self):
         return self
@@ -37,47 +68,156 @@ class ModulesDataset:
 
     def recycle_module(self, module, index):
         """ default recycling method for modules.
+        The new parameters only depend on the (self.seed, index) key:
+        - if the module has a `reset_parameters` method accepting a `key`
+          argument, as LinearProjector, it is called with this key.
+        - if it has a `reset_parameters` method without such argument, it is
+          called with the global random state temporarily seeded from the
+          key. The global random state is restored afterwards.
+        - otherwise, all parameters are drawn from a standard normal
+          distribution with counter-based random numbers.
         We need to make sure all recycling are performed with the same
         random sequence, which means it must be done on the same device.
         self.device is used here for this reason."""
-        params = module.state_dict()
-        torch.manual_seed(index)
         if (
                 hasattr(module, 'reset_parameters')
                 and callable(module.reset_parameters)):
             # we have a reset_parameters function. we need to call it after
             # being sure the module is on the right device
             module = module.to(self.device)
-            module.reset_parameters()
+            if 'key' in inspect.signature(module.reset_parameters).parameters:
+                module.reset_parameters(key=(self.seed, index))
+                return
+            device = torch.device(self.device)
+            devices = []
+            if device.type == 'cuda':
+                devices = [device.index if device.index is not None
+                           else torch.cuda.current_device()]
+            with _global_rng_lock, torch.random.fork_rng(devices=devices):
+                torch.manual_seed((self.seed << 32) + index)
+                module.reset_parameters()
         else:
             params = module.state_dict()
-            for key in params:
-                params[key] = torch.randn(
-                    params[key].shape,
-                    device=self.device)
+            for (offset, key) in enumerate(params):
+                params[key] = philox.normal(
+                    params[key].shape, self.seed, index,
+                    offset=offset, device=self.device)[0]
             module.load_state_dict(params)
 
+    def fingerprint(self):
+        """a string identifying the modules of this dataset: two datasets
+        with the same fingerprint generate the same modules."""
+        return hashlib.sha1(repr(
+            ('%s.%s' % (self.module_class.__module__,
+                        self.module_class.__qualname__),
+             sorted((key, repr(value))
+                    for (key, value) in self.parameters.items()),
+             self.seed, str(self.device))).encode()).hexdigest()
+
+    def _create(self, index):
+        """creates a module for some index. If the module_class accepts a
+        `key` argument, as LinearProjector, the module is created with the
+        (self.seed, index) key, so that the global random state is not used.
+
+        returns the module, and whether its parameters still have to be
+        generated. They do not if it was created with its key on CPU. On
+        other devices, they are generated again there, see
+        `recycle_module`."""
+        if 'key' not in inspect.signature(self.module_class).parameters:
+            return (self.module_class(**self.parameters).to(self.device),
+                    True)
+        module = self.module_class(key=(self.seed, index), **self.parameters)
+        return (module.to(self.device),
+                torch.device(self.device).type != 'cpu')
+
+    def _generate(self, module, index, generate):
+        """generates the parameters of a module for some index if needed,
+        and puts them in the cache, if any"""
+        if generate:
+            self.recycle_module(module, index)
+        if self.cache is not None:
+            self.cache.put(index, {key: value.detach().clone()
+                                   for (key, value)
+                                   in module.state_dict().items()})
+
+    def new_module(self, index):
+        """creates a new module for some index, with its parameters. If they
+        are cached, the module is a copy of a template module, to which they
+        are given, so that nothing is generated. Otherwise, it is created
+        and generated, see `_create`. The module is tagged as in
+        `load_module`."""
+        params = None if self.cache is None else self.cache.get(index)
+        if params is None:
+            (module, generate) = self._create(index)
+            self._generate(module, index, generate)
+        else:
+            if self.template is None:
+                self.template = self._create(index)[0]
+            module = copy.deepcopy(self.template)
+            module.load_state_dict(params)
+        module.projector_key = (self.fingerprint(), index)
+        return module
+
+    def load_module(self, module, index):
+        """give its parameters for some index to a module, either from the
+        cache or by recycling it. The module is tagged with a
+        `projector_key` attribute, the (fingerprint, index) tuple identifying
+        it, which is used for caching its sketches."""
+        module.projector_key = (self.fingerprint(), index)
+        params = None if self.cache is None else self.cache.get(index)
+        if params is not None:
+            module.to(self.device).load_state_dict(params)
+            return
+        self._generate(module, index, True)
+
+    def cache_info(self):
+        """statistics of the cache of parameters, or None if there is no
+        cache"""
+        return None if self.cache is None else self.cache.info()
+
     def __getitem__(self, indexes):
         # get items, possibly using recycling
+        if isinstance(indexes, torch.Tensor) and not indexes.dim():
+            indexes = indexes.item()
         if isinstance(indexes, int):
-            if self.recycle:
-                # only keeping track of a `current`
-                # for singleton queries, not for list
-                if self.current is None:
-                    self.current = self.module_class(**self.parameters)
-                result = self.current.to(self.device)
-            else:
-                result = self.module_class(**self.parameters).to(self.device)
-            self.recycle_module(result, indexes)
+            if not self.recycle:
+                return self.new_module(indexes)
+            # only keeping track of a `current`
+            # for singleton queries, not for list
+            if self.current is None:
+                self.current = self.new_module(indexes)
+                return self.current
+            result = self.current.to(self.device)
+            self.load_module(result, indexes)
             return result
         else:
-            result = []
-            for index in indexes:
-                new_module = (self.module_class(**self.parameters)
-                              .to(self.device))
-                ModulesDataset.recycle_module(new_module, index)
-                result += [new_module]
-            return result
+            return [self.new_module(int(index)) for index in indexes]
+
+    def bank(self, indexes):
+        """get the modules for several indexes as a single module, that
+        applies all of them at once. Its output has shape
+        (num_samples, len(indexes)) + output shape of each module.
+
+        If the module_class has a `bank` class method, as LinearProjector,
+        it generates all the modules in one vectorized call, identical to the
+        modules obtained one by one. It receives the indexes, the device, the
+        seed and the parameters of the dataset.
+
+        Otherwise, or if the dataset has a cache, the modules are obtained
+        one by one, so that the cached ones are not generated. They are
+        then stacked with the `stack` class method of the module_class, as
+        LinearProjector, or else in a StackedModules object."""
+        if isinstance(indexes, torch.Tensor):
+            indexes = indexes.view(-1).tolist()
+        bank_fn = getattr(self.module_class, 'bank', None)
+        if self.cache is None and callable(bank_fn):
+            return bank_fn(indexes, device=self.device, seed=self.seed,
+                           **self.parameters)
+        modules = self(list(indexes))
+        stack_fn = getattr(self.module_class, 'stack', None)
+        if callable(stack_fn):
+            return stack_fn(modules)
+        return StackedModules(modules)
 
     def __call__(self, indexes):
         # get items, without recycling (new items necessarily)
@@ -88,11 +228,100 @@ class ModulesDataset:
         return result
 
 
+class StackedModules(torch.nn.Module):
+    """Several modules of the same class, with parameters of the same
+    shapes, applied at once. Its output has shape
+    (num_samples, len(modules)) + output shape of each module.
+
+    The parameters and buffers of the modules are stacked, and the modules
+    are evaluated in a single vectorized call with `torch.func.vmap`. If it
+    is not available, or if the modules cannot be vectorized, e.g. because
+    they modify their buffers, they are applied one after the other. The
+    latter case is detected on the first call, with a warning.
+
+    The stacked parameters are copies that do not require gradients. If
+    some parameters of the modules require gradients, the modules are hence
+    applied one after the other, so that gradients reach them.
+
+    modules: iterable of Modules
+        the modules. They must be distinct objects.
+    """
+
+    def __init__(self, modules):
+        super(StackedModules, self).__init__()
+        self.stacked = torch.nn.ModuleList(modules)
+        self.vectorized = vmap is not None
+        # the stacked parameters and buffers, computed on demand
+        self.state = None
+
+    @staticmethod
+    def compatible(modules):
+        """whether some modules can be stacked: they must have the same class,
+        and parameters and buffers of the same shapes"""
+        modules = list(modules)
+        if not modules:
+            return False
+
+        def shapes(module):
+            return [(key, value.shape) for (key, value) in
+                    list(module.named_parameters())
+                    + list(module.named_buffers())]
+
+        # the shapes of the first module are computed once, and compared to
+        # the others until one differs
+        reference = shapes(modules[0])
+        return all(type(module) is type(modules[0])
+                   and shapes(module) == reference
+                   for module in modules[1:])
+
+    def _storage(self):
+        return [(tensor.device, tensor.dtype, tensor.data_ptr())
+                for tensor in list(self.parameters()) + list(self.buffers())]
+
+    def _apply(self, fn, *args, **kwargs):
+        # the stacked state must be computed again if the modules are moved
+        # or converted, not when `to` does nothing, as for each batch
+        storage = self._storage()
+        result = super(StackedModules, self)._apply(fn, *args, **kwargs)
+        if self._storage() != storage:
+            self.state = None
+        return result
+
+    def _call(self, params, buffers, input):
+        return functional_call(self.stacked[0], (params, buffers), (input,))
+
+    def forward(self, input):
+        if self.vectorized and not any(parameter.requires_grad for parameter
+                                       in self.parameters()):
+            if self.state is None:
+                self.state = stack_module_state(list(self.stacked))
+            try:
+                result = vmap(self._call, in_dims=(0, 0, None))(
+                    self.state[0], self.state[1], input)
+                return result.movedim(0, 1)
+            except torch.cuda.OutOfMemoryError:
+                raise
+            except RuntimeError as e:
+                # if the modules fail one by one too, this is a genuine error
+                # and it is raised. Otherwise, vmap does not support them
+                result = self._loop(input)
+                warnings.warn('StackedModules: cannot vectorize %s modules '
+                              '(%s), applying them one after the other.'
+                              % (type(self.stacked[0]).__name__, e))
+                self.vectorized = False
+                self.state = None
+                return result
+        return self._loop(input)
+
+    def _loop(self, input):
+        return torch.stack([module(input) for module in self.stacked], dim=1)
+
+
 class TransformedDataset:
     """ Create a dataset """
 
     def __init__(self, dataset, transform=None, target_transform=None,
-                 device='cpu'):
+                 device='cpu', batched=False, cache=None):
         """Create a TransformeDataset object, whose items are obtained by
         applying a specified torch Module to the items and the targets of
         some other dataset.
@@ -110,6 +339,21 @@ class TransformedDataset:
             the transforms will be sent in each process in the case this
             dataset is used with a DataStream object. Otherwise, it's up to
             the user to make sure that the transform is on this right device.
+        batched: boolean
+            if True, accessing a list of indices gives a single batch (X, y):
+            the items are stacked, and the transforms are applied once on the
+            whole batch, so they must accept batches of samples. Use it with
+            a DataLoader with `batch_sampler()` as sampler and
+            batch_size=None, as done by DataStream.
+        cache: SampleCache, string or None
+            if provided, the transformed items are cached, so that the
+            transforms are only computed once for each item. They must hence
+            be deterministic. A string is the path of the on-disk tier of a
+            new SampleCache, that is shared by all processes, e.g. by the
+            workers of a DataStream, and only lasts for one run. Provide a
+            SampleCache with a namespace for a persistent one. The on-disk
+            tier is only used if the dataset can be identified, see
+            `fingerprint`.
 
         Warning
         -------
@@ -126,6 +370,57 @@ class TransformedDataset:
         # initially, the dataset is not packed for streaming
         self.packed = False
         self.device = device
+        self.batched = batched
+        if isinstance(cache, str):
+            cache = SampleCache(path=cache)
+        self.cache = cache
+
+    def batch_sampler(self, batch_size=600, shuffle=False, drop_last=False):
+        """a sampler of lists of indices, for getting whole batches from a
+        batched dataset with a DataLoader"""
+        sampler = RandomSampler(self) if shuffle else SequentialSampler(self)
+        return BatchSampler(sampler, batch_size, drop_last)
+
+    def _cached(self, indices):
+        """the cached items for some indices, None for the missing ones"""
+        if self.cache is None:
+            return [None, ] * len(indices)
+        if self.cache.length is None:
+            self.cache.bind(self.fingerprint(), len(self))
+        return [self.cache.get(int(id)) for id in indices]
+
+    def _batch(self, indices):
+        """gets the items for some indices as a single batch (X, y), with
+        the transforms applied once on the stacked items that are not
+        cached"""
+        indices = list(indices)
+        items = self._cached(indices)
+        missing = [pos for (pos, item) in enumerate(items) if item is None]
+        if missing:
+            (X, y) = self._transform_batch([indices[pos] for pos in missing])
+            for (rank, pos) in enumerate(missing):
+                items[pos] = (X[rank], y[rank])
+                if self.cache is not None:
+                    # the rows are copied, so that the cache does not keep
+                    # the whole batch
+                    self.cache.put(int(indices[pos]),
+                                   tuple(item.clone() for item in items[pos]))
+            if len(missing) == len(items):
+                return (X, y)
+        return (torch.stack([item[0].to(self.device) for item in items]),
+                torch.stack([item[1].to(self.device) for item in items]))
+
+    def _transform_batch(self, indices):
+        items = [self.dataset[id] for id in indices]
+        X = torch.stack([torch.as_tensor(item[0]) for item in items])
+        y = [item[1] for item in items]
+        y = (torch.stack(y) if isinstance(y[0], torch.Tensor)
+             else torch.as_tensor(y))
+        X = X.to(self.device)
+        y = y.to(self.device)
+        return (X if self.transform is None else self.transform(X),
+                y if self.target_transform is None
+                else self.target_transform(y))
 
     def __getitem__(self, indices):
         if self.packed:
@@ -141,21 +436,54 @@ class TransformedDataset:
         except TypeError as te:
             indices = [indices]
             iterable = False
+        if self.batched:
+            (X, y) = self._batch(indices)
+            return (X, y) if iterable else (X[0], y[0])
         result = []
-        for id in indices:
+        for (id, cached) in zip(indices, self._cached(indices)):
+            if cached is not None:
+                result += [tuple(item.to(self.device) for item in cached)]
+                continue
             (X, y) = self.dataset[id]
             if isinstance(X, torch.Tensor):
                 X = X.to(self.device)
             if isinstance(y, torch.Tensor):
                 y = y.to(self.device)
-            #import ipdb; ipdb.set_trace()
             result += [
              (X if self.transform is None else self.transform(X),
               (y if self.target_transform is None
                else self.target_transform(y)))
             ]
+            if self.cache is not None:
+                self.cache.put(int(id), result[-1])
         return result[0] if not iterable else result
 
+    def fingerprint(self):
+        """a string identifying this dataset, from the fingerprint of the
+        original dataset and the transforms, without applying them. The
+        transforms are identified by their structure, as given by their
+        repr, and by their state. Returns None if the original dataset
+        cannot be identified, or if a transform is not a torch Module, as
+        plain functions cannot be told apart."""
+        dataset_fingerprint = fingerprint(self.dataset)
+        if dataset_fingerprint is None:
+            return None
+        hasher = hashlib.sha1()
+        hasher.update(dataset_fingerprint.encode())
+        for transform in (self.transform, self.target_transform):
+            if transform is None:
+                hasher.update(b'None')
+                continue
+            if not isinstance(transform, torch.nn.Module):
+                return None
+            hasher.update(('%s.%s' % (type(transform).__module__,
+                                      type(transform).__qualname__)).encode())
+            hasher.update(repr(transform).encode())
+            for (key, value) in transform.state_dict().items():
+                hasher.update(key.encode())
+                hasher.update(fingerprint(value).encode())
+        return hasher.hexdigest()
+
     def _pack(self):
         """prepare the dataset for streaming
 
@@ -1,30 +1,65 @@
 # imports
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 import torch.multiprocessing as mp
-from math import floor
 import atexit
-from functools import partial
-from contextlib import contextmanager
+import queue
+import time
+import math
+from .cache import fingerprint
+from .broadcast import BatchBroadcast
 
 
 class DataStream:
-    "A DataStream object puts items from a Dataset into a queue"
+    """A DataStream object puts items from a Dataset into a queue.
+
+    The stream is started with `stream` and stopped with `stop`, which
+    terminates the data worker process. It can also be used as a context
+    manager, which stops it on exit.
+
+    For datasets that fit in memory, the `in_memory` mode loads the whole
+    dataset once in shared memory instead. Batches are then drawn directly
+    from it by the consumers with the `batches` iterator, without any data
+    worker nor queue.
+
+    In `broadcast` mode, the queue is a BatchBroadcast: each batch is read
+    by all consumers instead of one, e.g. by all the workers of a stream of
+    sketches, so that loading it is only paid once."""
 
     def __init__(self,
                  dataset,
                  device='cpu',
                  num_workers=2,
-                 num_epochs=-1, queue=None):
+                 num_epochs=-1, queue=None,
+                 in_memory=False, batch_size=600, broadcast=False):
         """creates a new datastream object. If num_epoch is negative, will
-        loop endlessly. If the queue object is None, will create a new one"""
+        loop endlessly. If the queue object is None, will create a new one.
+        When all epochs are over, a None sentinel is put in the queue.
 
-        # Allocate the data queue if not provided
-        if queue is None:
-            self.queue = mp.Queue(maxsize=30)
+        If in_memory is True, the dataset is loaded in shared memory as a
+        SharedBatches object, available as the `batches` attribute, that
+        gives endless batches of batch_size random samples. The queue and
+        num_epochs are then not used, and the stream needs not be
+        started.
 
-        # create a new multiprocessing manager
-        self.manager = mp.Manager()
+        If broadcast is True or an int, the queue is a BatchBroadcast of
+        batches of batch_size samples, with this maximum number of
+        subscribers, by default the number of CPUs."""
+        self.batches = None
+        if in_memory:
+            self.batches = SharedBatches.from_dataset(
+                dataset, batch_size=batch_size, device=device)
+            queue = None
+        elif broadcast:
+            queue = BatchBroadcast.for_dataset(
+                dataset, batch_size,
+                (mp.cpu_count() if broadcast is True else broadcast),
+                device=device)
+        # Allocate the data queue if not provided
+        elif queue is None:
+            queue = mp.Queue(maxsize=30)
+        self.queue = queue
 
         # if the dataset has a `_pack` function, we call it now
         packfn = getattr(dataset, '_pack', None)
@@ -32,53 +67,302 @@ class DataStream:
             print('we call pack')
             packfn()
 
-        # prepare some data for the synchronization of the workers
-        self.params = self.manager.dict()
-
-        self.params['dataset'] = dataset
-        self.params['die'] = False
-        self.params['num_epochs'] = num_epochs
-
-        # create a lock
-        self.lock = mp.Lock()
+        # the event for stopping the worker
+        self.die = mp.Event()
+        self.process = None
 
+        self.dataset = dataset
+        self.num_epochs = num_epochs
         self.device = device
         self.num_workers = num_workers
+        self.batch_size = batch_size
+
+    def fingerprint(self):
+        """a string identifying the data of the stream"""
+        return fingerprint(self.dataset)
 
     def stream(self):
+        if self.batches is not None:
+            # in memory, there is nothing to start
+            return
         # let's go
+        self.stop()
+        self.die.clear()
         self.process = mp.Process(
                             target=data_worker,
                             kwargs={'device': self.device,
                                     'num_workers': self.num_workers,
-                                    'lock': self.lock,
-                                    'params': self.params,
+                                    'dataset': self.dataset,
+                                    'num_epochs': self.num_epochs,
+                                    'batch_size': self.batch_size,
+                                    'die': self.die,
                                     'data_queue': self.queue})
-        #atexit.register(partial(exit_handler, stream=self))
+        atexit.register(self.stop)
         self.process.start()
 
+    start = stream
+
+    def join(self, timeout=None):
+        """waits for the end of the stream"""
+        if self.process is not None:
+            self.process.join(timeout)
+
+    def stop(self, timeout=5):
+        """stops the stream: the data worker is asked to stop, and the queue
+        is drained until it does. If it does not stop within the timeout, it
+        is terminated."""
+        if self.process is None:
+            return
+        atexit.unregister(self.stop)
+        self.die.set()
+        deadline = time.time() + timeout
+        while self.process.is_alive() and time.time() < deadline:
+            drain(self.queue)
+            self.process.join(0.1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        drain(self.queue)
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def loader(dataset, batch_size, shuffle=False, **kwargs):
+    """a DataLoader for the batches of a dataset. For a batched dataset, as a
+    TransformedDataset with `batched=True`, the dataset is directly accessed
+    with the lists of indices of its `batch_sampler`, so that each batch is
+    built in one call."""
+    if getattr(dataset, 'batched', False):
+        return DataLoader(dataset, batch_size=None,
+                          sampler=dataset.batch_sampler(batch_size, shuffle),
+                          **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      **kwargs)
+
+
+class SharedBatches:
+    """Endless iterator of random batches of a dataset held in memory.
+
+    The samples and targets are stored in two tensors, in shared memory for
+    CPU, so that the object can be sent to other processes without copying
+    them. Each batch is made of independent uniformly random indexes, whose
+    samples are gathered with `index_select` in buffers that are allocated
+    once: no data is collated, and a batch is only valid until the next one
+    is drawn.
+
+    Each process draws its batches with its own random generator, seeded
+    from the OS, and has its own buffers. A forked process inherits those of
+    its parent, and must call `reset` before drawing batches.
+
+    X: Tensor (num_samples,) + sample_shape
+        the samples
+    Y: Tensor (num_samples,) + target_shape
+        the targets
+    batch_size: int
+        the number of samples in a batch
+    """
+
+    def __init__(self, X, Y, batch_size=600):
+        if X.device.type == 'cpu':
+            X, Y = X.share_memory_(), Y.share_memory_()
+        self.X = X
+        self.Y = Y
+        self.batch_size = min(batch_size, len(X))
+        self.generator = None
+        self.buffers = None
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size=600, device='cpu'):
+        """loads a dataset of (X, y) items in memory"""
+        X, Y, position = None, None, 0
+        for (X_batch, Y_batch) in loader(dataset, 600):
+            if X is None:
+                X = torch.empty((len(dataset),) + X_batch.shape[1:],
+                                dtype=X_batch.dtype, device=device)
+                Y = torch.empty((len(dataset),) + Y_batch.shape[1:],
+                                dtype=Y_batch.dtype, device=device)
+            X[position:position + len(X_batch)] = X_batch
+            Y[position:position + len(Y_batch)] = Y_batch
+            position += len(X_batch)
+        return cls(X, Y, batch_size)
+
+    def __len__(self):
+        return len(self.X)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.generator is None:
+            self.generator = torch.Generator()
+            self.generator.seed()
+            self.buffers = tuple(
+                torch.empty((self.batch_size,) + data.shape[1:],
+                            dtype=data.dtype, device=data.device)
+                for data in (self.X, self.Y))
+        indexes = torch.randint(len(self.X), (self.batch_size,),
+                                generator=self.generator)
+        indexes = indexes.to(self.X.device)
+        return tuple(torch.index_select(data, 0, indexes, out=buffer)
+                     for (data, buffer) in zip((self.X, self.Y),
+                                               self.buffers))
+
+    def get(self, block=True, timeout=None):
+        """gets a batch, as from a queue"""
+        return next(self)
+
+    def fingerprint(self):
+        return fingerprint(self.X)
+
+    def reset(self):
+        """drops the generator and buffers, which are created anew on the
+        next batch. To be called by forked processes."""
+        self.generator = None
+        self.buffers = None
+
+    def __getstate__(self):
+        # each process has its own generator and buffers
+        state = self.__dict__.copy()
+        state['generator'] = None
+        state['buffers'] = None
+        return state
+
+
+class SubsetSampler:
+    """Endless iterator of random subsets of a random-access dataset.
+
+    Each item is a batch (X, y) of `num_examples` samples drawn by index
+    from the dataset, so that a Sketcher with the same `num_examples` uses
+    exactly one subset for each sketch. Contrary to a DataStream, there is
+    no data worker: each process draws and loads its own subsets, and the
+    throughput of a stream of sketches only depends on its workers.
+
+    The strategies for drawing the indexes of a subset are:
+    - 'random': uniformly at random, without replacement.
+    - 'stratified': the indexes are split in `num_examples` strata of equal
+      sizes, and one index is drawn uniformly in each.
+    - 'lowdiscrepancy': the indexes are a randomly shifted golden ratio
+      sequence, which covers the dataset more evenly than random ones.
+
+    dataset: Tensor or Dataset
+        the data. For a Tensor, y is None.
+    num_examples: int
+        the size of each subset
+    strategy: string
+        the strategy for drawing the indexes, see above
+    seed: int or None
+        the seed of the random generator. If None, each process has its own
+        generator, seeded from the OS. Otherwise, the sequence of subsets is
+        reproducible, and is the same in all processes.
+    device: string
+        the device to which the subsets are sent
+    """
+
+    STRATEGIES = ('random', 'stratified', 'lowdiscrepancy')
+
+    def __init__(self, dataset, num_examples, strategy='random', seed=None,
+                 device='cpu'):
+        if strategy not in self.STRATEGIES:
+            raise Exception('SubsetSampler: unknown strategy %s, must be '
+                            'one of %s' % (strategy, self.STRATEGIES))
+        self.dataset = dataset
+        self.num_examples = min(num_examples, len(dataset))
+        self.strategy = strategy
+        self.seed = seed
+        self.device = device
+        self.generator = None
+
+    def __iter__(self):
+        return self
+
+    def indexes(self):
+        """draws the indexes of the next subset"""
+        if self.generator is None:
+            self.generator = torch.Generator()
+            if self.seed is None:
+                self.generator.seed()
+            else:
+                self.generator.manual_seed(self.seed)
+        length = len(self.dataset)
+        if self.strategy == 'random':
+            return torch.randperm(length,
+                                  generator=self.generator)[:self.num_examples]
+        if self.strategy == 'stratified':
+            positions = (torch.arange(self.num_examples, dtype=torch.float64)
+                         + torch.rand(self.num_examples, dtype=torch.float64,
+                                      generator=self.generator))
+            positions = positions / self.num_examples
+        else:
+            positions = (torch.rand(1, dtype=torch.float64,
+                                    generator=self.generator)
+                         + torch.arange(self.num_examples, dtype=torch.float64)
+                         * (math.sqrt(5.) - 1.) / 2.) % 1.
+        return (positions * length).long().clamp(max=length - 1)
+
+    def __next__(self):
+        indexes = self.indexes()
+        if isinstance(self.dataset, torch.Tensor):
+            (X, Y) = (self.dataset[indexes], None)
+        elif getattr(self.dataset, 'batched', False):
+            (X, Y) = self.dataset[indexes.tolist()]
+        else:
+            (X, Y) = default_collate([self.dataset[index]
+                                      for index in indexes.tolist()])
+        device = torch.device(self.device)
+        return (X.to(device), Y if Y is None else Y.to(device))
+
+    def fingerprint(self):
+        """a string identifying the data"""
+        return fingerprint(self.dataset)
+
+    def reset(self):
+        """drops the generator, which is created anew on the next subset.
+        To be called by forked processes."""
+        self.generator = None
+
+    def __getstate__(self):
+        # the generator is created anew in each process
+        state = self.__dict__.copy()
+        state['generator'] = None
+        return state
+
+
+def drain(data_queue):
+    """removes all items from a queue, without blocking. The batches of a
+    BatchBroadcast are released by their subscribers instead."""
+    if isinstance(data_queue, BatchBroadcast):
+        return
+    while True:
+        try:
+            data_queue.get(block=False)
+        except queue.Empty:
+            return
+
 
 def exit_handler(stream):
     print('Terminating data worker...')
-    if stream.params is not None:
-        stream.params['die'] = True
-    stream.process.join()
+    stream.stop()
     print('done')
 
 
-def data_worker(device, num_workers, lock, params, data_queue):
-    @contextmanager
-    def getlock():
-        # get the lock of the stream to manipulate the stream.data
-        result = lock.acquire(block=True)
-        yield result
-        if result:
-            lock.release()
+def data_worker(device, num_workers, dataset, num_epochs, batch_size, die,
+                data_queue):
+    def put(item):
+        # put an item, unless we are asked to stop in the meantime
+        while not die.is_set():
+            try:
+                data_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
     epoch = 0
-    with getlock():
-        dataset = params['dataset']
-        num_epochs = params['num_epochs']
 
     device_obj = torch.device(device)
     if device == 'cuda' and not dataset[0][0].is_cuda:
@@ -95,18 +379,18 @@ def data_worker(device, num_workers, lock, params, data_queue):
         print('[DataStream] the dataset is on CPU, and CPU is asked. '
               'Multiprocessing.')
         kwargs = {'num_workers': num_workers}
-    data_source = DataLoader(dataset, batch_size=600, **kwargs)
+    data_source = loader(dataset, batch_size, **kwargs)
 
     print('[DataStream] Starting the sampling with %d workers'
           % num_workers)
     while num_epochs < 0 or epoch < num_epochs:
-        check = 100
         for (X, Y) in data_source:
-            data_queue.put((X.to(device_obj), Y.to(device_obj)))
-            check -= 1
-            if check == 0:
-                check = 100
-                with getlock():
-                    if params['die']:
-                        return
+            if not put((X.to(device_obj), Y.to(device_obj))):
+                return
         epoch += 1
+
+    # the stream is over. We wait until the queue is consumed before
+    # exiting, because tensors in the queue may still need this process
+    if put(None):
+        while not die.is_set() and not data_queue.empty():
+            time.sleep(0.1)
@@ -1,14 +1,30 @@
 import torch
+import copy
+import math
 import queue
-from .datastream import DataStream
+import threading
+from .datastream import DataStream, SubsetSampler
 from .datasets import ModulesDataset
-from .sketch import Sketcher, sketch
+from .sketch import Sketcher, sketch, checkpointed
+from functools import partial
+from . import philox
+from .bank import SketchBank
+from .ring import SketchRing
 from torchsearchsorted import searchsorted
 
 
 # A class for random normalized linear projections, which is the module under
 class LinearProjector(torch.nn.Linear):
-    def __init__(self, input_shape, num_projections):
+    def __init__(self, input_shape, num_projections, key=None):
+        """Creates random normalized linear projections.
+
+        input_shape: tuple of int
+            the shape of the samples
+        num_projections: int or tuple of int
+            the number or shape of the projections
+        key: tuple (seed, index) or None
+            identifies the random projections, that are a deterministic
+            function of it. If None, a random key is drawn."""
         self.dim_in = torch.prod(torch.tensor(input_shape))
         try:
             _ = iter(num_projections)
@@ -16,11 +32,12 @@ class LinearProjector(torch.nn.Linear):
         except TypeError as te:
             self.shape_out = [num_projections, ]
         self.dim_out = torch.prod(torch.tensor(self.shape_out))
+        self.key = key
+        # this calls reset_parameters
         super(LinearProjector, self).__init__(
             in_features=self.dim_in,
             out_features=self.dim_out,
             bias=False)
-        self.reset_parameters()
 
     def forward(self, input):
         input = input.view(input.shape[0], -1)
@@ -29,13 +46,91 @@ class LinearProjector(torch.nn.Linear):
         result = result.view(-1, *self.shape_out)
         return result
 
-    def reset_parameters(self):
-        super(LinearProjector, self).reset_parameters()
-        new_weight = self.weight
+    def reset_parameters(self, key=None):
+        """draws new random weights, identified by a (seed, index) key. If it
+        is None, the key of the projector is used, or a random one."""
+        if key is None:
+            key = self.key
+        if key is None:
+            key = torch.randint(low=0, high=2**31, size=(2,)).tolist()
+        (seed, index) = key
+        self.weight = torch.nn.Parameter(
+            type(self).random_weights(
+                [index], int(self.dim_in), self.shape_out, seed=seed,
+                device=self.weight.device)[0])
+
+    @staticmethod
+    def random_weights(indexes, input_shape, num_projections, seed=0,
+                       device='cpu'):
+        """generates the weights of several projectors at once, in a single
+        vectorized call. They are drawn from a standard normal distribution
+        and normalized, so that the projections are uniform on the sphere.
+
+        The weights for each index are exactly the ones obtained for that
+        index from a ModulesDataset of LinearProjector with the same seed.
 
+        indexes: iterable of int or Tensor
+            the indexes of the projectors
+        input_shape, num_projections:
+            the parameters of the projectors, as for the constructor
+        seed: int
+            the seed for the projectors
+
+        returns a Tensor (len(indexes), dim_out, dim_in)"""
+        dim_in = int(torch.prod(torch.tensor(input_shape)))
+        dim_out = int(torch.prod(torch.tensor(num_projections)))
+        weights = philox.normal((dim_out, dim_in), seed, indexes,
+                                device=device)
         # make sure each projector is normalized
-        self.weight = torch.nn.Parameter(
-           new_weight/torch.norm(new_weight, dim=1, keepdim=True))
+        return weights / torch.norm(weights, dim=-1, keepdim=True)
+
+    @staticmethod
+    def block_size(dim_in):
+        """the number of projections that are drawn jointly for an index by
+        `random_weights`: splitting projections by blocks of this size
+        keeps their joint distribution, see `sw`"""
+        return 1
+
+    @classmethod
+    def bank(cls, indexes, input_shape, num_projections, seed=0,
+             device='cpu'):
+        """creates a single LinearProjector that stacks the projectors of
+        the given indexes, so that they are all applied with one product.
+        Its output has shape (num_samples, len(indexes)) + shape_out.
+
+        indexes: iterable of int or Tensor
+            the indexes of the projectors to stack
+        input_shape, num_projections:
+            the parameters of the projectors, as for the constructor
+        seed: int
+            the seed for the projectors"""
+        weights = cls.random_weights(indexes, input_shape, num_projections,
+                                     seed=seed, device=device)
+        return cls._stacked(weights, input_shape, num_projections, seed,
+                            device)
+
+    @classmethod
+    def stack(cls, projectors):
+        """creates a single LinearProjector that stacks some projectors,
+        as `bank`. Their weights are copied."""
+        weights = torch.stack([projector.weight.detach()
+                               for projector in projectors])
+        return cls._stacked(weights, [int(projectors[0].dim_in), ],
+                            projectors[0].shape_out, 0, weights.device)
+
+    @classmethod
+    def _stacked(cls, weights, input_shape, num_projections, seed, device):
+        # create a small projector, and give it the stacked weights
+        projector = cls(input_shape, 1, key=(seed, 0)).to(device)
+        try:
+            projector.shape_out = [len(weights), ] + list(num_projections)
+        except TypeError as te:
+            projector.shape_out = [len(weights), num_projections]
+        projector.dim_out = torch.prod(torch.tensor(projector.shape_out))
+        projector.out_features = int(projector.dim_out)
+        projector.weight = torch.nn.Parameter(
+            weights.view(-1, weights.shape[-1]))
+        return projector
 
     def eval(self):
         self.weight.requires_grad = False
@@ -48,7 +143,237 @@ class LinearProjector(torch.nn.Linear):
         return torch.mm(grad.view(grad.shape[0], -1), self.weight)
 
 
-def sw(batch1, batch2, num_projections=1000):
+class OrthogonalProjector(LinearProjector):
+    """Random normalized linear projections, that are orthogonal.
+
+    The projections of a projector are drawn as for LinearProjector, and
+    are then orthonormalized with a QR decomposition, by blocks of the input
+    dimension if there are more projections than that. Orthogonal directions
+    cover the sphere more evenly than independent ones, which reduces the
+    variance of the sliced Wasserstein distance for the same number of
+    projections. The constructor parameters are those of LinearProjector."""
+
+    @staticmethod
+    def block_size(dim_in):
+        return dim_in
+
+    @staticmethod
+    def random_weights(indexes, input_shape, num_projections, seed=0,
+                       device='cpu'):
+        """generates the weights of several projectors at once, see
+        `LinearProjector.random_weights`. All the QR decompositions are
+        batched."""
+        dim_in = int(torch.prod(torch.tensor(input_shape)))
+        dim_out = int(torch.prod(torch.tensor(num_projections)))
+        num_blocks = -(-dim_out // dim_in)
+        block = min(dim_in, dim_out)
+        weights = philox.normal((num_blocks, block, dim_in), seed, indexes,
+                                device=device)
+        (q, r) = torch.linalg.qr(weights.transpose(-1, -2))
+        # fixing the signs, so that the directions are uniform
+        q = q * torch.sign(torch.diagonal(r, dim1=-2, dim2=-1))[..., None, :]
+        weights = q.transpose(-1, -2).reshape(len(weights), -1, dim_in)
+        return weights[:, :dim_out]
+
+
+class SobolProjector(LinearProjector):
+    """Random normalized linear projections, with low-discrepancy directions.
+
+    The directions are obtained from a scrambled Sobol sequence, mapped to
+    Gaussian vectors with the inverse normal distribution function and
+    normalized. The projector of index i takes the first num_projections
+    points of the sequence, scrambled with a seed drawn from its (seed, i)
+    key: the directions of a projector are low-discrepancy, and those of
+    different projectors are independent. The constructor parameters are
+    those of LinearProjector. The input dimension is limited to the one of
+    `torch.quasirandom.SobolEngine`."""
+
+    @staticmethod
+    def block_size(dim_in):
+        # the Sobol points are balanced by powers of 2
+        return 2 ** int(math.ceil(math.log2(dim_in)))
+
+    @staticmethod
+    def random_weights(indexes, input_shape, num_projections, seed=0,
+                       device='cpu'):
+        """generates the weights of several projectors at once, see
+        `LinearProjector.random_weights`"""
+        dim_in = int(torch.prod(torch.tensor(input_shape)))
+        dim_out = int(torch.prod(torch.tensor(num_projections)))
+        if dim_in > torch.quasirandom.SobolEngine.MAXDIM:
+            raise Exception('SobolProjector: the input dimension cannot be '
+                            'larger than %d.'
+                            % torch.quasirandom.SobolEngine.MAXDIM)
+        scrambles = philox.random_words(1, seed, indexes)[:, 0].tolist()
+        points = []
+        for scramble in scrambles:
+            engine = torch.quasirandom.SobolEngine(dim_in, scramble=True,
+                                                   seed=scramble)
+            points += [engine.draw(dim_out, dtype=torch.float64), ]
+        points = torch.stack(points).clamp(1e-7, 1. - 1e-7)
+        weights = torch.erfinv(2. * points - 1.).float().to(device)
+        return weights / torch.norm(weights, dim=-1, keepdim=True)
+
+
+def fwht(input):
+    """fast Walsh-Hadamard transform along the last dimension of a Tensor,
+    whose size must be a power of 2. It is not normalized."""
+    shape = input.shape
+    dim = shape[-1]
+    step = 1
+    while step < dim:
+        input = input.reshape(-1, dim // (2 * step), 2, step)
+        input = torch.stack((input[:, :, 0] + input[:, :, 1],
+                             input[:, :, 0] - input[:, :, 1]), dim=2)
+        step *= 2
+    return input.reshape(shape)
+
+
+class HadamardProjector(torch.nn.Module):
+    def __init__(self, input_shape, num_projections, key=None):
+        """Creates random normalized structured projections.
+
+        The input is padded to a power of 2, multiplied by random signs and
+        transformed with a fast Walsh-Hadamard transform, and some random
+        entries of the result are kept. Each projection is hence a row of a
+        randomized Hadamard matrix, restricted to the input entries and
+        normalized. If the input dimension is a power of 2, the projections
+        are orthogonal within blocks of that size. Otherwise, the padding
+        breaks their orthogonality. Several blocks with independent signs are
+        used if more projections are needed.
+
+        Contrary to LinearProjector, no matrix is stored: the projector only
+        keeps the signs and the indices of the projections, and applying it
+        costs O(d log d) for an input of dimension d.
+
+        input_shape: tuple of int
+            the shape of the samples
+        num_projections: int or tuple of int
+            the number or shape of the projections
+        key: tuple (seed, index) or None
+            identifies the random projections, that are a deterministic
+            function of it. If None, a random key is drawn."""
+        super(HadamardProjector, self).__init__()
+        self.dim_in = torch.prod(torch.tensor(input_shape))
+        try:
+            _ = iter(num_projections)
+            self.shape_out = num_projections
+        except TypeError as te:
+            self.shape_out = [num_projections, ]
+        self.dim_out = torch.prod(torch.tensor(self.shape_out))
+        dim = 2 ** int(math.ceil(math.log2(int(self.dim_in))))
+        num_blocks = -(-int(self.dim_out) // dim)
+        self.register_buffer('signs', torch.ones(num_blocks, dim))
+        self.register_buffer('indices', torch.zeros(int(self.dim_out),
+                                                    dtype=torch.int64))
+        self.key = key
+        self.reset_parameters()
+
+    def forward(self, input):
+        input = input.view(input.shape[0], -1)
+        # the rows restricted to the input entries have dim_in entries of
+        # magnitude 1, whatever the padding
+        scale = math.sqrt(input.shape[1])
+        dim = self.signs.shape[-1]
+        if dim > input.shape[1]:
+            input = torch.nn.functional.pad(input, (0, dim - input.shape[1]))
+        result = fwht(input[:, None, :] * self.signs) / scale
+        result = result.reshape(input.shape[0], -1)[:, self.indices]
+        return result.view(-1, *self.shape_out)
+
+    def reset_parameters(self, key=None):
+        """draws new random signs and indices, identified by a (seed, index)
+        key. If it is None, the key of the projector is used, or a random
+        one."""
+        if key is None:
+            key = self.key
+        if key is None:
+            key = torch.randint(low=0, high=2**31, size=(2,)).tolist()
+        (seed, index) = key
+        (signs, indices) = HadamardProjector.random_parameters(
+            [index], int(self.dim_in), self.shape_out, seed=seed,
+            device=self.signs.device)
+        self.signs = signs[0]
+        self.indices = indices[0]
+
+    @staticmethod
+    def random_parameters(indexes, input_shape, num_projections, seed=0,
+                          device='cpu'):
+        """generates the signs and indices of several projectors at once.
+
+        returns a float Tensor of signs (len(indexes), num_blocks, dim) and
+        an int64 Tensor of indices (len(indexes), dim_out)"""
+        dim_in = int(torch.prod(torch.tensor(input_shape)))
+        dim_out = int(torch.prod(torch.tensor(num_projections)))
+        dim = 2 ** int(math.ceil(math.log2(dim_in)))
+        num_blocks = -(-dim_out // dim)
+        words = philox.random_words(num_blocks * dim, seed, indexes,
+                                    device=device)
+        signs = ((words & 1) * 2 - 1).float().view(-1, num_blocks, dim)
+        # a random subset of the rows of all blocks
+        order = philox.uniform((num_blocks * dim,), seed, indexes, offset=1,
+                               device=device)
+        indices = torch.argsort(order, dim=1)[:, :dim_out]
+        return (signs, indices)
+
+    @classmethod
+    def bank(cls, indexes, input_shape, num_projections, seed=0,
+             device='cpu'):
+        """creates a single HadamardProjector that stacks the projectors of
+        the given indexes. Its output has shape (num_samples, len(indexes))
+        + shape_out, see `LinearProjector.bank`."""
+        (signs, indices) = cls.random_parameters(
+            indexes, input_shape, num_projections, seed=seed, device=device)
+        return cls._stacked(signs, indices, input_shape, num_projections,
+                            seed, device)
+
+    @classmethod
+    def stack(cls, projectors):
+        """creates a single HadamardProjector that stacks some projectors,
+        as `bank`"""
+        signs = torch.stack([projector.signs for projector in projectors])
+        indices = torch.stack([projector.indices
+                               for projector in projectors])
+        return cls._stacked(signs, indices, [int(projectors[0].dim_in), ],
+                            projectors[0].shape_out, 0, signs.device)
+
+    @classmethod
+    def _stacked(cls, signs, indices, input_shape, num_projections, seed,
+                 device):
+        projector = cls(input_shape, 1, key=(seed, 0)).to(device)
+        try:
+            projector.shape_out = [len(indices), ] + list(num_projections)
+        except TypeError as te:
+            projector.shape_out = [len(indices), num_projections]
+        projector.dim_out = torch.prod(torch.tensor(projector.shape_out))
+        # the indices of each projector are shifted to its own blocks
+        offsets = torch.arange(len(indices), device=device)[:, None]
+        projector.signs = signs.view(-1, signs.shape[-1])
+        projector.indices = (indices
+                             + offsets * signs.shape[1] * signs.shape[2]
+                             ).view(-1)
+        return projector
+
+    def columns(self, start, stop):
+        """a projector giving the flattened outputs of this one from start to
+        stop, sharing its signs"""
+        projector = copy.copy(self)
+        projector._buffers = dict(self._buffers)
+        projector.indices = self.indices[start:stop]
+        projector.shape_out = [stop - start, ]
+        projector.dim_out = torch.tensor(stop - start)
+        return projector
+
+
+def _sw(projectors, percentiles, max_memory, batch1, batch2):
+    """sum of the squared errors between the sketches of two batches"""
+    sketch1 = sketch(projectors, batch1, percentiles, max_memory=max_memory)
+    sketch2 = sketch(projectors, batch2, percentiles, max_memory=max_memory)
+    return torch.nn.MSELoss(reduction='sum')(sketch1, sketch2)
+
+
+def sw(batch1, batch2, num_projections=1000, max_memory=None, seed=None,
+       projector_class=LinearProjector):
     """directly compute the sliced Wasserstein distance between two
     batches of samples. This is done by randomly picking random projections,
     sketching the batches with them, and compute the squared error between
@@ -57,25 +382,87 @@ def sw(batch1, batch2, num_projections=1000):
 
     batch1: Tensor, (num_samples,) + shape
     batch2: Tensor, (num_samples,) + shape
+    num_projections: int
+        the number of projections
+    max_memory: int or None
+        if provided, an approximate budget in bytes for the projections. They
+        are then generated and sketched by chunks, and the intermediate
+        results are computed again in the backward pass. The result is the
+        same. A chunk has at least one block of projections, see below.
+    seed: int or None
+        the seed of the projections. If None, a random one is drawn.
+    projector_class: LinearProjector or a subclass, or HadamardProjector
+        the class of the projections. For LinearProjector and its
+        subclasses, the projections are drawn by blocks of
+        `projector_class.block_size` projections, each block being
+        identified by its index: a single projection for LinearProjector,
+        orthogonal blocks of the input dimension for OrthogonalProjector.
+        A HadamardProjector is obtained with the seed as key, and split by
+        its outputs.
     """
 
     # check that dimensions match
     if batch1.shape[1:] != batch2.shape[1:]:
         raise Exception('sw: except the first one, dimension of the batches '
                         'must match.')
-    projectors = LinearProjector(input_shape=batch1.shape[1:],
-                                 num_projections=num_projections)
+    if seed is None:
+        seed = torch.randint(low=0, high=2**31, size=(1,)).item()
 
     # pick the smallest of the two number of samples as the number of quantiles
     num_percentiles = min(batch1.shape[0], batch2.shape[0])
     percentiles = torch.linspace(0, 100, num_percentiles)
 
-    # compute the percentiles on the two batches_features
-    sketch1 = sketch(projectors, batch1, percentiles)
-    sketch2 = sketch(projectors, batch2, percentiles)
+    # the number of projections in each chunk: for each projection, its
+    # weights, the projected samples, and their sorted values and indices
+    dim_in = int(torch.prod(torch.tensor(batch1.shape[1:])))
+    chunk = num_projections
+    if max_memory is not None:
+        num_samples = max(batch1.shape[0], batch2.shape[0])
+        chunk = max(1, max_memory // (batch1.element_size()
+                                      * (dim_in + 4 * num_samples)))
 
-    # return SW as the sum of the squared error between them
-    return torch.nn.MSELoss(reduction='sum')(sketch1, sketch2)
+    projector = None
+    if issubclass(projector_class, LinearProjector):
+        # the chunks are made of whole blocks
+        block = projector_class.block_size(dim_in)
+        chunk = block * max(1, (-(-chunk // block) if max_memory is None
+                                else chunk // block))
+    else:
+        projector = projector_class(input_shape=batch1.shape[1:],
+                                    num_projections=num_projections,
+                                    key=(seed, 0)).to(batch1.device)
+        if not callable(getattr(projector, 'columns', None)):
+            # the projector cannot be split
+            chunk = num_projections
+
+    # compute the percentiles on the two batches, and return SW as the sum
+    # of the squared error between them
+    loss = 0
+    for start in range(0, num_projections, chunk):
+        stop = min(start + chunk, num_projections)
+        if projector is None:
+            projectors = projector_class.bank(
+                list(range(start // block, -(-stop // block))),
+                input_shape=batch1.shape[1:], num_projections=block,
+                seed=seed, device=batch1.device)
+            # the last block may give more projections than needed
+            projectors.weight = torch.nn.Parameter(
+                projectors.weight[:stop - start])
+            projectors.shape_out = [stop - start, ]
+            projectors.dim_out = torch.tensor(stop - start)
+            projectors.out_features = stop - start
+        elif chunk < num_projections:
+            projectors = projector.columns(start, stop)
+        else:
+            projectors = projector
+        for parameter in projectors.parameters():
+            parameter.requires_grad_(False)
+        function = partial(_sw, projectors, percentiles, max_memory)
+        if max_memory is not None:
+            loss = loss + checkpointed(function, batch1, batch2)
+        else:
+            loss = loss + function(batch1, batch2)
+    return loss
 
 
 class GSW:
@@ -97,7 +484,18 @@ class GSW:
                  asynchronous=True,
                  device='cpu',
                  num_workers_data=2,
-                 num_sketchers=2):
+                 data_in_memory=False,
+                 data_broadcast=False,
+                 sampling=None,
+                 num_sketchers=2,
+                 sketch_error=None,
+                 sketch_cache=None,
+                 sketch_bank=None,
+                 sketcher=None,
+                 prefetch=True,
+                 max_memory=None,
+                 incremental=None,
+                 projector_class=LinearProjector):
         """Create a GSW object.
 
         Parameters:
@@ -137,16 +535,107 @@ class GSW:
         num_workers_data: int
             the number of workers to use for the DataStream (to get data from
             the dataset)
+        data_in_memory: boolean
+            if True, the dataset is loaded once in shared memory, from which
+            the sketchers directly draw their batches, instead of getting them
+            from a DataStream worker. This is much faster for datasets that
+            fit in memory.
+        data_broadcast: boolean
+            if True, each batch of the DataStream is read by all sketchers
+            from shared memory, instead of going to a single one, so that
+            loading the data is only paid once for all of them.
+        sampling: string or None
+            if provided, no DataStream is used: each sketch is computed on
+            its own subset of num_examples samples, drawn by index from the
+            dataset by a SubsetSampler with this strategy ('random',
+            'stratified' or 'lowdiscrepancy'). The throughput of sketching
+            then only depends on the sketchers.
         num_sketchers: int
-            the number of workers to use for computing sketches"""
-        self.datastream = DataStream(dataset, device=device,
-                                     num_workers=num_workers_data)
-        self.datastream.stream()
-        self.num_percentiles = num_percentiles
-        self.percentiles = torch.linspace(0, 100, num_percentiles)
-        self.sketcher = Sketcher(data_source=self.datastream,
-                                 percentiles=self.percentiles,
-                                 num_examples=num_examples)
+            the number of workers to use for computing sketches
+        sketch_error: float or None
+            if provided, the target quantiles are computed with bounded memory
+            streaming summaries, with this normalized rank error. If None,
+            they are exact.
+        sketch_cache: SketchCache, string or None
+            if provided, the target quantiles are cached, so that they are
+            computed only once for each projector, even across runs if the
+            cache has an on-disk tier. A string is the path of this tier.
+        sketch_bank: SketchBank, string or None
+            if provided, the targets are drawn from this precomputed bank of
+            sketches (see `build_sketch_bank`), or from the bank file with
+            this path. No stream is started, and the percentiles are the
+            ones of the bank, num_percentiles being ignored. The projectors
+            must be the ones used for building the bank.
+        sketcher: Sketcher or None
+            if provided, an existing Sketcher on the dataset, used instead of
+            creating a new one along with its DataStream. Its pool of workers
+            is kept alive when this object is closed, so that several GSW
+            objects used one after the other share it and do not start
+            processes. Its percentiles and num_examples are set by this
+            object, sketch_error and sketch_cache are ignored.
+        prefetch: boolean
+            only for asynchronous mode. If True, a background thread gathers
+            the next targets from the stream, stacked and on the device, so
+            that refreshing the targets does not wait for them.
+        max_memory: int or None
+            if provided, an approximate budget in bytes for the projections,
+            both for sketching the targets and the batches. They are then
+            computed by chunks, see `sketch`.
+        incremental: float or None
+            if provided, the projectors are drawn once, and their targets are
+            then updated at each refresh with a single new batch of data,
+            instead of sketching num_examples samples anew. The update
+            averages the targets with the sketches of the new batch, with a
+            weight 1/n for the n-th update, but never less than this rate, so
+            that older data is eventually forgotten. Targets are computed
+            synchronously in that case. Not compatible with sketch_bank.
+        projector_class: LinearProjector or a subclass, or HadamardProjector
+            the class of the projectors, when `projectors` is an int. The
+            HadamardProjector is much cheaper for high dimensional data, the
+            OrthogonalProjector and SobolProjector give better estimates
+            with the same number of projections."""
+        if incremental is not None and sketch_bank is not None:
+            raise ValueError('GSW: incremental targets cannot be used with '
+                             'a sketch bank.')
+        if isinstance(sketch_bank, str):
+            sketch_bank = SketchBank(sketch_bank)
+        self.sketch_bank = sketch_bank
+        self.own_sketcher = sketcher is None
+        if sketch_bank is None and sketcher is not None:
+            self.datastream = None
+            self.num_percentiles = num_percentiles
+            self.percentiles = torch.linspace(0, 100, num_percentiles)
+            self.sketcher = sketcher
+            self.sketcher.percentiles = self.percentiles
+            self.sketcher.num_examples = num_examples
+            self.sketcher.max_memory = max_memory
+        elif sketch_bank is None:
+            if sampling is None:
+                self.datastream = DataStream(dataset, device=device,
+                                             num_workers=num_workers_data,
+                                             in_memory=data_in_memory,
+                                             broadcast=data_broadcast)
+                self.datastream.stream()
+                data_source = self.datastream
+            else:
+                self.datastream = None
+                data_source = SubsetSampler(dataset, num_examples,
+                                            strategy=sampling, device=device)
+            self.num_percentiles = num_percentiles
+            self.percentiles = torch.linspace(0, 100, num_percentiles)
+            self.sketcher = Sketcher(data_source=data_source,
+                                     percentiles=self.percentiles,
+                                     num_examples=num_examples,
+                                     error=sketch_error,
+                                     cache=sketch_cache,
+                                     max_memory=max_memory)
+        else:
+            # the targets are read from the bank, no data is needed
+            self.datastream = None
+            self.sketcher = None
+            self.num_percentiles = sketch_bank.num_percentiles
+            self.percentiles = sketch_bank.percentiles
+            asynchronous = False
         if isinstance(projectors, int):
             # trying to access the first item from the dataset to identify the
             # shape automatically. We support the case where an item is a
@@ -157,46 +646,209 @@ class GSW:
                 first_item = first_item[0]
             data_shape = first_item.shape
             self.projectors = ModulesDataset(
-                                    module_class=LinearProjector,
+                                    module_class=projector_class,
                                     device=device,
                                     input_shape=data_shape,
                                     num_projections=projectors)
         else:
             self.projectors = projectors
+        if (sketch_bank is not None
+                and sketch_bank.projectors_fingerprint is not None
+                and hasattr(self.projectors, 'fingerprint')
+                and (sketch_bank.projectors_fingerprint
+                     != self.projectors.fingerprint())):
+            raise Exception('GSW: the sketch bank was not built with these '
+                            'projectors.')
+        self.incremental = incremental
+        if incremental is not None:
+            asynchronous = False
         self.asynchronous = asynchronous
         if asynchronous:
             self.sketcher.stream(modules=self.projectors,
                                  num_sketches=-1,
                                  num_epochs=1,
-                                 num_workers=num_sketchers)
+                                 num_workers=num_sketchers,
+                                 ordered=False)
         self.target_percentiles = None
         self.projector_ids = None
+        # the ids of the current projectors, and their batched form
+        self._batched = (None, None)
+        # the number of sketches merged in the targets, and the projectors
+        # being updated with their ids, in incremental mode
+        self.num_updates = 0
+        self._updated = (None, None)
         self.manual_refresh = manual_refresh
         self.batchsize = batchsize
         self.device = device
+        self.max_memory = max_memory
+
+        # the prefetching thread puts the next targets in a queue of size 1:
+        # along with the current targets, this is a double buffer
+        self.prefetched = None
+        self.prefetcher = None
+        self.stop_prefetching = threading.Event()
+        if asynchronous and prefetch:
+            self.prefetched = queue.Queue(maxsize=1)
+            self.prefetcher = threading.Thread(target=self._prefetch,
+                                               daemon=True)
+            self.prefetcher.start()
+
+    def _gather(self):
+        """gets the next batchsize targets from the stream, as a Tensor
+        (batchsize, num_percentiles, dim), along with their ids. Returns None
+        if prefetching is stopped in the meantime."""
+        stream = self.sketcher.queue
+        targets = []
+        ids = []
+        while len(ids) < self.batchsize:
+            if self.stop_prefetching.is_set():
+                return None
+            try:
+                if isinstance(stream, SketchRing):
+                    with stream.reading(timeout=1) as item:
+                        if item is not None:
+                            targets += [item[0].clone(), ]
+                            ids += [item[1], ]
+                    continue
+                item = stream.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is not None:
+                targets += [item[0], ]
+                ids += [item[1], ]
+        return (torch.stack(targets), ids)
+
+    def _prefetch(self):
+        """prefetching thread"""
+        device = torch.device(self.device)
+        while not self.stop_prefetching.is_set():
+            try:
+                item = self._gather()
+                if item is None:
+                    return
+                (targets, ids) = item
+                if device.type == 'cuda':
+                    targets = targets.pin_memory().to(device,
+                                                      non_blocking=True)
+                else:
+                    targets = targets.to(device)
+                item = (targets, ids)
+            except Exception as e:
+                # given to the consumer, which raises it
+                item = e
+            while not self.stop_prefetching.is_set():
+                try:
+                    self.prefetched.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
+
+    def close(self):
+        """stops the sketching and data streams of the GSW object, if any,
+        terminating their processes. The workers of a sketcher that was
+        provided are kept."""
+        if self.prefetcher is not None:
+            self.stop_prefetching.set()
+            self.prefetcher.join()
+            self.prefetcher = None
+        if self.sketcher is not None and self.own_sketcher:
+            self.sketcher.close()
+        elif self.sketcher is not None:
+            self.sketcher.stop()
+        if self.datastream is not None:
+            self.datastream.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def refresh(self):
         """refreshes the targets of the GSW object
 
         This function draws anew the projections to use for the computation
         of the GSW cost, and computes the associated target percentiles on the
-        data.
+        data. The targets are stacked in a single Tensor
+        (batchsize, num_percentiles, dim).
         """
-        if self.asynchronous:
+        if self.prefetcher is not None:
+            # swapping with the prefetched targets
+            item = self.prefetched.get()
+            if isinstance(item, Exception):
+                raise item
+            (self.target_percentiles, self.projector_ids) = item
+        elif self.asynchronous and isinstance(self.sketcher.queue,
+                                              SketchRing):
+            # getting all targets at once from the ring
+            (self.target_percentiles,
+             self.projector_ids) = self.sketcher.queue.get_many(
+                self.batchsize)
+        elif self.asynchronous:
             self.target_percentiles = []
             self.projector_ids = []
-            for item in range(self.batchsize):
-                    (target_percentiles,
-                     projector_id) = self.sketcher.queue.get()
-                    self.target_percentiles += [target_percentiles, ]
-                    self.projector_ids += [projector_id, ]
-        else:
+            while len(self.projector_ids) < self.batchsize:
+                item = self.sketcher.queue.get()
+                if item is None:
+                    continue
+                self.target_percentiles += [item[0], ]
+                self.projector_ids += [item[1], ]
+            self.target_percentiles = torch.stack(self.target_percentiles)
+        elif (self.incremental is not None
+              and self.target_percentiles is not None):
+            # merging the sketches of a new batch in the targets
+            ids = [int(id) for id in self.projector_ids]
+            if self._updated[0] != ids:
+                self._updated = (ids, self._modules(ids))
+            self.num_updates += 1
+            rate = max(self.incremental, 1. / self.num_updates)
+            self.target_percentiles = self.sketcher.update(
+                self._updated[1], self.target_percentiles, rate)
+        elif self.sketch_bank is not None:
+            # reading the targets from the bank
             self.projector_ids = torch.randint(low=0,
-                                               high=len(self.projectors),
+                                               high=len(self.sketch_bank),
                                                size=(self.batchsize,))
-            # avoiding to put all the projectors in memory, calling one by one
-            self.target_percentiles = [self.sketcher(self.projectors[id])
-                                       for id in self.projector_ids]
+            self.target_percentiles = self.sketch_bank[self.projector_ids]
+        else:
+            self.projector_ids = torch.randint(
+                low=0,
+                high=(len(self.projectors)
+                      if hasattr(self.projectors, '__len__')
+                      else torch.iinfo(torch.int16).max),
+                size=(self.batchsize,))
+            # sketching all projectors in a single pass over the data
+            self.target_percentiles = torch.stack(self.sketcher(
+                self._modules(self.projector_ids), fused=True))
+            self.num_updates = 1
+
+    def _modules(self, ids):
+        """the projectors of some ids, as distinct objects. A ModulesDataset
+        is called instead of indexed, so that it does not recycle them."""
+        if isinstance(self.projectors, ModulesDataset):
+            return self.projectors([int(id) for id in ids])
+        return [self.projectors[int(id)] for id in ids]
+
+    def batched_projectors(self):
+        """the current projectors, in a form that applies all of them at
+        once: a single module obtained with the `bank` method of the
+        projectors. It is kept as long as the targets are not refreshed.
+
+        Returns None if the projectors cannot be obtained this way, e.g. if
+        they are not a ModulesDataset."""
+        ids = tuple(int(id) for id in self.projector_ids)
+        if self._batched[0] == ids:
+            return self._batched[1]
+        projectors = None
+        if isinstance(self.projectors, ModulesDataset):
+            projectors = self.projectors.bank(list(ids))
+            # the gradients are only needed for the batch
+            for parameter in projectors.parameters():
+                parameter.requires_grad_(False)
+        self._batched = (ids, projectors)
+        return projectors
 
     def __call__(self, batch):
         """"compute the (generalized) sliced Wasserstein distance between
@@ -211,8 +863,7 @@ class GSW:
 
         # bringing the target percentiles to the batch device (if not done)
         # already
-        self.target_percentiles = [t.to(batch.device) for t in
-                                   self.target_percentiles]
+        self.target_percentiles = self.target_percentiles.to(batch.device)
 
         # if the batch is too small, we may have to reduce the number of
         # percentiles
@@ -226,13 +877,31 @@ class GSW:
             indices = Ellipsis
         percentiles = self.percentiles[indices].squeeze()
 
+        projectors = self.batched_projectors()
+        if projectors is not None:
+            # all projectors are applied at once, and their quantiles are
+            # computed in a single pass, as a Tensor (batchsize,
+            # num_percentiles, dim)
+            test_percentiles = sketch(projectors, batch, percentiles,
+                                      max_memory=self.max_memory)
+            test_percentiles = test_percentiles.view(
+                len(percentiles), len(self.projector_ids), -1
+                ).transpose(0, 1)
+            targets = self.target_percentiles
+            if indices is not Ellipsis:
+                targets = targets[:, indices.view(-1)]
+            return torch.nn.MSELoss()(
+                targets.view(test_percentiles.shape),
+                test_percentiles.to(batch.device))
+
         loss = torch.tensor(0, device=batch.device)
         for (projector_id, target_percentiles) in zip(
                                     self.projector_ids,
                                     self.target_percentiles):
             # get the projector
             projector = self.projectors[projector_id]
-            test_percentiles = sketch(projector, batch, percentiles)
+            test_percentiles = sketch(projector, batch, percentiles,
+                                      max_memory=self.max_memory)
             loss = loss + torch.nn.MSELoss()(
                 target_percentiles[indices].squeeze(),
                 test_percentiles.to(batch.device))
@@ -0,0 +1,116 @@
+"""Counter-based random numbers, computed with the Philox4x32-10 generator.
+
+Contrary to the torch generators, these random numbers do not depend on any
+state: they are a pure function of a key, made of a seed and an index, and of
+a counter giving the position in the random sequence. This means they can be
+generated concurrently in any thread or process, reproducibly, and without
+touching the global random state. All computations are vectorized over the
+indexes, so that the random numbers for a whole range of indexes are
+generated in a single call.
+
+All the 32 bits words are stored in int64 tensors, and products are split in
+16 bits halves so that nothing overflows.
+"""
+import math
+import torch
+
+MASK = 0xFFFFFFFF
+MULTIPLIERS = (0xD2511F53, 0xCD9E8D57)
+WEYL = (0x9E3779B9, 0xBB67AE85)
+
+
+def _mulhilo(a, b):
+    """high and low 32 bits words of the product of a, an int64 Tensor of
+    32 bits words, with a 32 bits constant b"""
+    t = (a & 0xFFFF) * b
+    u = (a >> 16) * b
+    low = t + ((u & 0xFFFF) << 16)
+    return (u >> 16) + (low >> 32), low & MASK
+
+
+def philox(counter, key, rounds=10):
+    """Philox4x32 bijection.
+
+    counter: tuple of 4 int64 Tensors
+        the 32 bits words of the counter. They are broadcast together.
+    key: tuple of 2 int64 Tensors
+        the 32 bits words of the key.
+
+    returns a tuple of 4 int64 Tensors with the random 32 bits words"""
+    (c0, c1, c2, c3) = counter
+    (k0, k1) = key
+    for round in range(rounds):
+        if round:
+            k0 = (k0 + WEYL[0]) & MASK
+            k1 = (k1 + WEYL[1]) & MASK
+        (hi0, lo0) = _mulhilo(c0, MULTIPLIERS[0])
+        (hi1, lo1) = _mulhilo(c2, MULTIPLIERS[1])
+        (c0, c1, c2, c3) = (hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0)
+    return (c0, c1, c2, c3)
+
+
+def _indexes(indexes, device):
+    if isinstance(indexes, int):
+        indexes = [indexes]
+    return torch.as_tensor(indexes, dtype=torch.int64,
+                           device=device).view(-1)
+
+
+def random_words(num, seed, indexes, offset=0, device='cpu'):
+    """random 32 bits words for several indexes.
+
+    num: int
+        the number of words for each index
+    seed: int
+        the seed, first word of the key
+    indexes: int, iterable of int or Tensor
+        the indexes, second word of the key
+    offset: int
+        selects an independent random sequence for the same key
+
+    returns an int64 Tensor (len(indexes), num)"""
+    def word(value):
+        return torch.tensor(value & MASK, dtype=torch.int64, device=device)
+
+    indexes = _indexes(indexes, device)
+    num_blocks = (num + 3) // 4
+    blocks = torch.arange(num_blocks, dtype=torch.int64, device=device)
+    words = philox(
+        counter=(blocks[None, :], word(offset), word(offset >> 32), word(0)),
+        key=(word(seed), indexes[:, None] & MASK))
+    words = [word.expand(len(indexes), num_blocks) for word in words]
+    return torch.stack(words, dim=-1).view(len(indexes), -1)[:, :num]
+
+
+def uniform(shape, seed, indexes, offset=0, device='cpu'):
+    """uniform random numbers in (0, 1) for several indexes.
+
+    returns a float Tensor (len(indexes),) + shape"""
+    num = int(torch.prod(torch.tensor(shape)).item())
+    words = random_words(num, seed, indexes, offset, device)
+    # keeping 23 bits, so that the result is exact and never 0 or 1 in float
+    result = ((words >> 9).float() + 0.5) / 2. ** 23
+    return result.view((-1,) + tuple(shape))
+
+
+def normal(shape, seed, indexes, offset=0, device='cpu'):
+    """standard normal random numbers for several indexes, obtained with the
+    Box-Muller transform.
+
+    returns a float Tensor (len(indexes),) + shape"""
+    num = int(torch.prod(torch.tensor(shape)).item())
+    half = (num + 1) // 2
+    u = uniform((2 * half,), seed, indexes, offset, device)
+    radius = torch.sqrt(-2. * torch.log(u[:, :half]))
+    angle = 2. * math.pi * u[:, half:]
+    result = torch.cat((radius * torch.cos(angle),
+                        radius * torch.sin(angle)), dim=1)[:, :num]
+    return result.reshape((-1,) + tuple(shape))
+
+
+def randint(high, seed, indexes, num=1, offset=0, device='cpu'):
+    """random integers in [0, high) for several indexes.
+
+    returns an int64 Tensor (len(indexes), num)"""
+    words = random_words(num, seed, indexes, offset, device)
+    return (words.double() / 2. ** 32 * high).long().clamp(max=high - 1)
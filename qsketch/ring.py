@@ -0,0 +1,140 @@
+import torch
+import torch.multiprocessing as mp
+import queue
+from multiprocessing.context import get_spawning_popen
+from contextlib import contextmanager
+
+# status of the slots of a ring
+FREE, WRITING, READY, READING = range(4)
+# ids of the slots holding a sentinel, and of those that are to be skipped
+# because writing them failed
+SENTINEL, SKIPPED = -1, -2
+
+
+class SketchRing:
+    """A fixed-capacity ring buffer of sketches in shared memory.
+
+    It is used as a multiprocessing queue of (sketch, id) items, where all
+    sketches have the same shape, but contrary to a Queue, items are never
+    pickled: the slots are preallocated shared tensors, producers write the
+    sketches in place and consumers can read them without any copy.
+
+    As for a queue, None is accepted as a sentinel item.
+
+    slots: int
+        the capacity of the ring
+    shape: tuple of int
+        the shape of each sketch
+    condition: multiprocessing Condition or None
+        the condition protecting the ring. If None, a new one is created.
+        Conditions can only be shared with processes by inheritance: a ring
+        sent through a queue loses it, and the receiver must `attach` the
+        condition it inherited.
+    """
+
+    def __init__(self, slots, shape, condition=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.data = torch.zeros((slots,) + self.shape).share_memory_()
+        self.ids = torch.zeros(slots, dtype=torch.int64).share_memory_()
+        self.status = torch.zeros(slots, dtype=torch.int8).share_memory_()
+        # number of slots taken by producers and consumers so far
+        self.counters = torch.zeros(2, dtype=torch.int64).share_memory_()
+        # the condition protecting the indices and status
+        self.condition = mp.Condition() if condition is None else condition
+
+    def attach(self, condition):
+        """sets the condition of a ring received through a queue"""
+        self.condition = condition
+        return self
+
+    def __getstate__(self):
+        # the condition can only be pickled when spawning a process
+        state = self.__dict__.copy()
+        if get_spawning_popen() is None:
+            state['condition'] = None
+        return state
+
+    def _wait(self, slot_counter, status, block, timeout):
+        """waits until the next slot for producers or consumers has some
+        status, and returns it after incrementing the counter. Must be called
+        with the condition acquired."""
+        while True:
+            slot = int(self.counters[slot_counter]) % self.slots
+            if self.status[slot] == status:
+                self.counters[slot_counter] += 1
+                return slot
+            if not block or not self.condition.wait(timeout):
+                raise (queue.Full if status == FREE else queue.Empty)()
+
+    def _set(self, slot, status):
+        with self.condition:
+            self.status[slot] = status
+            self.condition.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        """puts an item, which is either a (sketch, id) tuple or None. The
+        sketch is written in place in the next free slot"""
+        with self.condition:
+            slot = self._wait(0, FREE, block, timeout)
+            self.status[slot] = WRITING
+        # the copy is done without holding the lock. If it fails, e.g.
+        # because the sketch has the wrong shape, the slot is still made
+        # ready, so that it does not block the consumers, which skip it.
+        try:
+            if item is None:
+                self.ids[slot] = SENTINEL
+            else:
+                (sketch, id) = item
+                self.data[slot].copy_(sketch.view(self.shape))
+                self.ids[slot] = id
+        except BaseException:
+            self.ids[slot] = SKIPPED
+            raise
+        finally:
+            self._set(slot, READY)
+
+    @contextmanager
+    def reading(self, block=True, timeout=None):
+        """context manager to get the next item without copy. It yields
+        either None for a sentinel, or a (sketch, id) tuple, where sketch
+        is a view on the ring, only valid within the context"""
+        with self.condition:
+            while True:
+                slot = self._wait(1, READY, block, timeout)
+                if int(self.ids[slot]) != SKIPPED:
+                    break
+                self.status[slot] = FREE
+                self.condition.notify_all()
+            self.status[slot] = READING
+        try:
+            id = int(self.ids[slot])
+            yield None if id == SENTINEL else (self.data[slot], id)
+        finally:
+            self._set(slot, FREE)
+
+    def get(self, block=True, timeout=None):
+        """gets the next item, either None or a (sketch, id) tuple, with the
+        sketch copied out of the ring"""
+        with self.reading(block, timeout) as item:
+            return None if item is None else (item[0].clone(), item[1])
+
+    def get_many(self, count):
+        """gets the next `count` sketches, skipping sentinels, stacked in a
+        single Tensor (count,) + shape, along with the list of their ids"""
+        sketches = torch.empty((count,) + self.shape)
+        ids = []
+        while len(ids) < count:
+            with self.reading() as item:
+                if item is None:
+                    continue
+                sketches[len(ids)] = item[0]
+                ids += [item[1], ]
+        return (sketches, ids)
+
+    def qsize(self):
+        with self.condition:
+            return int(self.counters[0] - self.counters[1])
+
+    def empty(self):
+        return self.qsize() == 0
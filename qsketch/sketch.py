@@ -1,15 +1,21 @@
 # imports
 import torch
 from torch.utils.data import Dataset, DataLoader
-from torchpercentile import Percentile
+from torch.utils.checkpoint import checkpoint
+from functools import partial
 import atexit
 import queue
-from .datasets import ModulesDataset
-from .datastream import DataStream
+from multiprocessing.context import get_spawning_popen
+from .datasets import ModulesDataset, StackedModules
+from .datastream import DataStream, SharedBatches, drain, loader
+from .summary import QuantileSummary
+from .cache import SketchCache, fingerprint
+from .ring import SketchRing
+from .broadcast import BatchBroadcast, Subscriber
+from . import philox
 import multiprocessing.queues as queues
 import torch.multiprocessing as mp
-from contextlib import contextmanager
-import collections
+import collections.abc
 import time
 import warnings
 
@@ -19,26 +25,182 @@ def to_iterator(data_source):
         return None
 
     # try known stuff to make an iterator out of it
-    if isinstance(data_source, DataStream):
+    if isinstance(data_source, DataStream) and data_source.batches is not None:
+        data_iterator = data_source.batches
+    elif (isinstance(data_source, DataStream)
+          and isinstance(data_source.queue, BatchBroadcast)):
+        data_iterator = data_source.queue.subscriber()
+    elif isinstance(data_source, DataStream):
         data_iterator = iter(data_source.queue.get, None)
-    elif isinstance(data_source, queues.Queue):
+    elif isinstance(data_source, SharedBatches):
+        data_iterator = data_source
+    elif isinstance(data_source, BatchBroadcast):
+        data_iterator = data_source.subscriber()
+    elif isinstance(data_source, (queues.Queue, SketchRing, PoolResults)):
         data_iterator = iter(data_source.get, None)
     elif isinstance(data_source, torch.Tensor):
         data_iterator = iter([[data_source, None]])
-    elif isinstance(data_source, Dataset):
-        data_iterator = DataLoader(data_source, batch_size=5000)
+    elif (isinstance(data_source, Dataset)
+          or getattr(data_source, 'batched', False)):
+        data_iterator = iter(loader(data_source, 5000))
     elif isinstance(data_source, DataLoader):
-        data_iterator = data_source
+        data_iterator = iter(data_source)
     else:
-        if isinstance(data_source, collections.Iterable):
+        if isinstance(data_source, collections.abc.Iterable):
             # it's iterable, assuming it's ok
-            data_iterator = data_source
+            data_iterator = iter(data_source)
         else:
             raise Exception('Sketcher: data_source type is not understood')
     return data_iterator
 
 
-def sketch(modules, data, percentiles, num_examples=None):
+def _all_linear(modules):
+    """checks whether all modules are LinearProjector objects on the same
+    input dimension, so that they can be applied with a single product"""
+    # imported here because gsw depends on this module
+    from .gsw import LinearProjector
+    return (all(isinstance(module, LinearProjector) for module in modules)
+            and len(set(int(module.dim_in) for module in modules)) == 1)
+
+
+def checkpointed(function, *tensors):
+    """applies a function on some tensors. If gradients are enabled, its
+    intermediate results are not kept for the backward pass, but computed
+    again, so that memory is only needed for one such call at a time."""
+    if not torch.is_grad_enabled():
+        return function(*tensors)
+    return checkpoint(function, *tensors, use_reentrant=False)
+
+
+def _read_batches(data_iterator, num_examples):
+    """reads batches from a data iterator, up to num_examples samples if it
+    is not None"""
+    batches = []
+    pos = 0
+    while num_examples is None or pos < num_examples:
+        try:
+            (imgs, labels) = next(data_iterator)
+        except StopIteration:
+            if num_examples is not None:
+                warnings.warn(
+                    'Number of datapoints not reaching %d, but'
+                    'only %d. Using this and continuing.' % (
+                           num_examples, pos))
+            break
+        if num_examples is not None:
+            imgs = imgs[:num_examples - pos]
+        if isinstance(data_iterator, (Subscriber, SharedBatches)):
+            # these batches are only valid until the next one
+            imgs = imgs.clone()
+        batches += [imgs, ]
+        pos += len(imgs)
+    return batches
+
+
+def _check_memory(num_examples, error, max_memory):
+    """raises an Exception if max_memory is combined with streaming
+    summaries over unbounded data: chunking keeps all the data in memory,
+    which defeats the purpose of these summaries"""
+    if max_memory is not None and error is not None and num_examples is None:
+        raise Exception('max_memory requires reading all the data, so it '
+                        'cannot be used with a sketching error when '
+                        'num_examples is None. Provide num_examples, or '
+                        'drop either max_memory or error.')
+
+
+def _linear_quantiles(percentiles, error, weight, *batches):
+    summary = QuantileSummary(error=error)
+    for batch in batches:
+        summary.update(torch.mm(batch.view(len(batch), -1), weight.t()))
+    return summary.quantiles(percentiles).float()
+
+
+def _module_quantiles(module, percentiles, error, *batches):
+    summary = QuantileSummary(error=error)
+    for batch in batches:
+        summary.update(module(batch).view(len(batch), -1))
+    return summary.quantiles(percentiles).float()
+
+
+def _chunked_quantiles(group, batches, percentiles, error, max_memory):
+    """computes the quantiles of the outputs of a group of modules on some
+    batches, by chunks of outputs whose exact summaries fit in max_memory
+    bytes. For LinearProjector objects, the chunks are slices of their
+    stacked weights. Modules with a `columns` method, as HadamardProjector,
+    are split with it. Otherwise, each module is a chunk.
+
+    returns the quantiles and the number of outputs of each module"""
+    num_samples = sum(len(batch) for batch in batches)
+    for module in group:
+        module.to(batches[0].device)
+    if _all_linear(group):
+        weight = torch.cat([module.weight for module in group])
+        sizes = [module.weight.shape[0] for module in group]
+        # the summary, the sorted values and their indices
+        columns = max(1, max_memory
+                      // (4 * weight.element_size() * num_samples))
+        quantiles = [
+            checkpointed(partial(_linear_quantiles, percentiles, error),
+                         weight[start:start + columns], *batches)
+            for start in range(0, weight.shape[0], columns)]
+    else:
+        quantiles = []
+        sizes = []
+        for module in group:
+            parts = [module, ]
+            if callable(getattr(module, 'columns', None)):
+                # structured projectors can be split by outputs
+                dim_out = int(module.dim_out)
+                columns = max(1, max_memory
+                              // (4 * batches[0].element_size()
+                                  * num_samples))
+                parts = [module.columns(start, min(start + columns, dim_out))
+                         for start in range(0, dim_out, columns)]
+            chunks = [
+                checkpointed(partial(_module_quantiles, part, percentiles,
+                                     error), *batches)
+                for part in parts]
+            quantiles += chunks
+            sizes += [sum(chunk.shape[1] for chunk in chunks), ]
+    return (torch.cat(quantiles, dim=1), sizes)
+
+
+def sketch(modules, data, percentiles, num_examples=None, error=None,
+           fused=False, max_memory=None):
+    """computes the quantiles of the output of one or several modules over
+    some data.
+
+    modules: torch Module or iterable of Modules
+        the modules to apply on the data
+    data: DataStream, Queue, Tensor, Dataset, DataLoader or iterable
+        the source of the data. Each item is a tuple (X, y)
+    percentiles: Tensor
+        the percentiles (between 0 and 100) to compute
+    num_examples: int or None
+        the number of samples to use. If None, all data is used
+    error: float or None
+        if provided, the quantiles are computed in a streaming fashion with a
+        bounded memory QuantileSummary, with this normalized rank error. This
+        allows sketching whole datasets or endless streams. If None, all the
+        outputs are kept and the quantiles are exact.
+    fused: boolean
+        if False, each module is sketched with its own data, taken anew from
+        the data source. If True, the data is read only once: all modules
+        are applied on each batch and their outputs are stacked, in a single
+        product if they are all LinearProjector objects. In that case, the
+        modules must be distinct objects (e.g. not recycled ones obtained
+        from a ModulesDataset), and num_examples applies to all of them.
+    max_memory: int or None
+        if provided, an approximate budget in bytes for the outputs of the
+        modules. The data is read first, and the quantiles are computed by
+        chunks of outputs, the intermediate results being discarded for each
+        chunk and computed again in the backward pass. The results are
+        identical. The outputs of a single module that is not a
+        LinearProjector cannot be split. Since all the data is kept, it
+        cannot be combined with an error if num_examples is None.
+    """
+    _check_memory(num_examples, error, max_memory)
+
     # check whether we want to sketch several modules or just one
     try:
         _ = iter(modules)
@@ -49,11 +211,34 @@ def sketch(modules, data, percentiles, num_examples=None):
 
     data_iterator = to_iterator(data)
 
-    # for each module
+    # the groups of modules that are applied together on each batch: all of
+    # them if fused, otherwise one at a time
+    groups = [list(modules)] if fused else [[module] for module in modules]
+
     sketches = []
-    for module in modules:
-        # allocate the processed variable, to None
-        processed = None
+    for group in groups:
+        if max_memory is not None:
+            batches = _read_batches(data_iterator, num_examples)
+            if not batches:
+                raise Exception('Did not get any data from data_source. '
+                                'Cannot sketch.')
+            (quantiles, sizes) = _chunked_quantiles(
+                group, batches, percentiles, error, max_memory)
+            sketches += list(torch.split(quantiles, sizes, dim=1))
+            continue
+
+        # the summary in which we accumulate the outputs of the modules
+        summary = QuantileSummary(error=error)
+
+        # if the modules are all linear, their weights will be stacked.
+        # Otherwise, if they are of the same class, they are applied at once
+        linear = len(group) > 1 and _all_linear(group)
+        weight = None
+        sizes = None
+        stacked = None
+        if (len(group) > 1 and not linear
+                and StackedModules.compatible(group)):
+            stacked = StackedModules(group)
 
         pos = 0
         # compute the projections by a loop over the data. By default, use
@@ -78,49 +263,39 @@ def sketch(modules, data, percentiles, num_examples=None):
                 n_imgs = min(len(imgs), num_examples - pos)
             else:
                 n_imgs = len(imgs)
-
-            # bring the module to the data device if it's not done already
-            module.to(imgs.device)
-
-            # apply the module after putting it on the data device
-            computed = module(imgs[:n_imgs])
-            # turn the output into a matrix
-            computed = computed.view(n_imgs, -1)
-
-            if processed is None:
-                # we computed for the first time. Now we have several
-                # options
-                if num_examples is not None:
-                    # We know the total number of elements. preallocate this
-                    processed = torch.empty((num_examples,
-                                             computed.shape[1]),
-                                            device=computed.device)
-                else:
-                    # We don't know the total number of elements. Just
-                    # allocate an empty tensor
-                    processed = torch.Tensor().to(computed.device)
-            if num_examples is not None:
-                # if the computations are preallocated, store them at the right
-                # place (faster)
-                processed[pos:pos+n_imgs] = computed
+            batch = imgs[:n_imgs]
+
+            # bring the modules to the data device if it's not done already
+            for module in group:
+                module.to(imgs.device)
+
+            # apply the modules after putting them on the data device, and
+            # feed the summary with their outputs stacked as a matrix
+            if linear:
+                if weight is None:
+                    weight = torch.cat([module.weight for module in group])
+                    sizes = [module.weight.shape[0] for module in group]
+                computed = torch.mm(batch.view(n_imgs, -1), weight.t())
+            elif stacked is not None:
+                computed = stacked(batch).reshape(n_imgs, -1)
+                sizes = [computed.shape[1] // len(group), ] * len(group)
             else:
-                # concatenate the result:
-                processed = torch.cat((processed, computed))
-            # in any case, augment the position
+                computed = [module(batch).view(n_imgs, -1)
+                            for module in group]
+                sizes = [output.shape[1] for output in computed]
+                computed = (computed[0] if len(computed) == 1
+                            else torch.cat(computed, dim=1))
+            summary.update(computed)
             pos += n_imgs
 
-        if processed is None:
+        if not summary.count:
             raise Exception('Did not get any data from data_source. '
                             'Cannot sketch.')
 
-        # truncating in case we don't get enough. Possibly no-op
-        processed = processed[:pos]
-
-        # flatten the samples to a matrix for the quantiles
-        processed = processed.view(processed.shape[0], -1)
-
-        # compute the quantiles for these projections
-        sketches += [Percentile()(processed, percentiles).float(), ]
+        # compute the quantiles for these projections, and split them back
+        # for each module
+        quantiles = summary.quantiles(percentiles).float()
+        sketches += list(torch.split(quantiles, sizes, dim=1))
     return sketches[0] if not iterable else sketches
 
 
@@ -131,13 +306,19 @@ class Sketcher:
 
     A Sketcher is accessed with a module as an index.
 
-    Optionally, a stream can be started, with a Dataset of modules
+    Optionally, a stream can be started, with a Dataset of modules. The
+    stream is computed by a SketchPool of workers, which is kept alive when
+    the stream is stopped, so that starting a new one is fast. The pool is
+    only shut down by `close`.
     """
 
     def __init__(self,
                  data_source,
                  percentiles,
-                 num_examples=None):
+                 num_examples=None,
+                 error=None,
+                 cache=None,
+                 max_memory=None):
         """
             Create a new sketcher.
             data_source: either None, or a DataStream, a Queue, a Tensor,
@@ -152,14 +333,67 @@ class Sketcher:
                 the number of samples to use for computing each sketch.
                 If None or if the data_source does not produce enough data,
                 all data will be used for sketching
+            error: float or None
+                if provided, the normalized rank error of the streaming
+                quantile summaries used for sketching. This bounds the memory
+                required, which is useful when num_examples is None or large.
+                If None, the sketches are exact.
+            cache: SketchCache, string or None
+                if provided, the sketches of modules obtained from a
+                ModulesDataset are cached, identified by the dataset of
+                modules, their index, the sketching parameters and a
+                fingerprint of the data_source. A string is the path of the
+                on-disk tier of a new SketchCache.
+            max_memory: int or None
+                if provided, the approximate budget in bytes for the outputs
+                of the modules, see `sketch`. It cannot be combined with an
+                error if num_examples is None.
         """
+        _check_memory(num_examples, error, max_memory)
         self.data_iterator = to_iterator(data_source)
         self.percentiles = percentiles
         self.num_examples = num_examples
+        self.error = error
+        self.max_memory = max_memory
+        if isinstance(cache, str):
+            cache = SketchCache(path=cache)
+        self.cache = cache
+        self.fingerprint = None
+        if cache is not None:
+            self.fingerprint = fingerprint(data_source)
+            if self.fingerprint is None:
+                warnings.warn('Sketcher: cannot identify the data_source, '
+                              'disabling the cache.')
+                self.cache = None
         self.queue = None
-        self.shared_data = None
+        self.state = None
+        self.schedule = None
+        self.pool = None
+
+    def cache_key(self, projector_key, percentiles=None):
+        """the key of the sketch of a projector in the cache, or None if
+        there is no cache.
+
+        projector_key: tuple (fingerprint, index) or None
+            identifies the projector, as the `projector_key` attribute of the
+            modules obtained from a ModulesDataset"""
+        if self.cache is None or projector_key is None:
+            return None
+        if percentiles is None:
+            percentiles = self.percentiles
+        return self.cache.key(projector_key[0], projector_key[1], percentiles,
+                              self.num_examples, self.error, self.fingerprint)
+
+    def lookup(self, projector_key, percentiles=None):
+        """returns the cached sketch of a projector, or None"""
+        key = self.cache_key(projector_key, percentiles)
+        return None if key is None else self.cache.get(key)
+
+    def __call__(self, modules, data=None, percentiles=None, fused=False):
+        # check the cache first, only for the default data
+        if data is None and self.cache is not None:
+            return self._cached_call(modules, percentiles, fused)
 
-    def __call__(self, modules, data=None, percentiles=None):
         # Use default if some parameters are not provided
         if data is None:
             data_iterator = self.data_iterator
@@ -175,7 +409,68 @@ class Sketcher:
         return sketch(modules=modules,
                       data=data_iterator,
                       percentiles=percentiles,
-                      num_examples=num_examples)
+                      num_examples=num_examples,
+                      error=self.error,
+                      fused=fused,
+                      max_memory=self.max_memory)
+
+    def _cached_call(self, modules, percentiles, fused):
+        try:
+            modules = list(modules)
+            iterable = True
+        except TypeError as te:
+            modules = [modules]
+            iterable = False
+        keys = [self.cache_key(getattr(module, 'projector_key', None),
+                               percentiles)
+                for module in modules]
+        sketches = [None if key is None else self.cache.get(key)
+                    for key in keys]
+        missing = [pos for (pos, value) in enumerate(sketches)
+                   if value is None]
+        if missing:
+            if self.data_iterator is None:
+                raise Exception('Sketcher has no default data. Aborting.')
+            computed = sketch(modules=[modules[pos] for pos in missing],
+                              data=self.data_iterator,
+                              percentiles=(self.percentiles
+                                           if percentiles is None
+                                           else percentiles),
+                              num_examples=self.num_examples,
+                              error=self.error,
+                              fused=fused,
+                              max_memory=self.max_memory)
+            for (pos, value) in zip(missing, computed):
+                sketches[pos] = value
+                if keys[pos] is not None:
+                    self.cache.put(keys[pos], value)
+        return sketches if iterable else sketches[0]
+
+    def update(self, modules, sketches, rate, percentiles=None):
+        """updates some sketches incrementally: the modules are sketched on
+        a single batch of the default data, and these new sketches are merged
+        with the previous ones by an exponential moving average.
+
+        modules: Module or iterable of Modules
+            the modules, as for calling the sketcher. Several modules are
+            fused.
+        sketches: Tensor
+            their current sketches, stacked for several modules
+        rate: float
+            the weight of the new sketches, between 0 and 1
+
+        returns the updated sketches, as a Tensor of the same shape"""
+        if self.data_iterator is None:
+            raise Exception('Sketcher has no default data. Aborting.')
+        try:
+            (X, y) = next(self.data_iterator)
+        except StopIteration:
+            raise Exception('Sketcher: no more data for updating sketches.')
+        new = self(modules, data=X, percentiles=percentiles, fused=True)
+        if not isinstance(new, torch.Tensor):
+            new = torch.stack(new)
+        new = new.detach().to(sketches.device).view(sketches.shape)
+        return sketches + rate * (new - sketches)
 
     def __getitem__(self, modules):
         # call the sketcher with default parameters
@@ -183,10 +478,26 @@ class Sketcher:
                     data=None,
                     percentiles=None)
 
+    def sketch_shape(self, modules):
+        """the shape of the sketches of a dataset of modules, or None if
+        it is unknown. It is known if the modules have a `dim_out` attribute,
+        as LinearProjector."""
+        dim_out = getattr(modules[0], 'dim_out', None)
+        if dim_out is None:
+            return None
+        return (len(self.percentiles), int(dim_out))
+
     def stream(self, modules, num_sketches, num_epochs,
-               num_workers=-1, max_id=None):
+               num_workers=-1, max_id=None, seed=None, ordered=True):
         """starts a stream of sketches
 
+        The sketches to compute are deterministically assigned to the
+        workers: the n-th sketch of the stream, counted over all epochs, is
+        computed by worker n % num_workers, and its id is drawn with
+        counter-based random numbers from the seed, the epoch and n. Hence,
+        workers never need to synchronize to pick their job, and only share
+        some progress counters for putting the sketches in epoch order.
+
         modules: ModulesDataset object
             the dataset of function to iterate upon
         num_sketches: int
@@ -199,8 +510,17 @@ class Sketcher:
             picking half of the local cores
         max_id: int or None
             the maximum index for modules.
+        seed: int or None
+            the seed for drawing the ids of the sketches. If None, a random
+            one is drawn.
+        ordered: boolean
+            if True, the sketches are put in the queue epoch by epoch, each
+            epoch being followed by a None sentinel. Workers that are ahead
+            wait until the previous epochs are over. If False, sketches are
+            put as soon as they are ready, and a single sentinel is put when
+            all epochs are over.
         """
-        # first stop if it was started before
+        # first stop if it was started before. The workers are kept.
         self.stop()
 
         # get the number of workers
@@ -210,224 +530,406 @@ class Sketcher:
             num_workers = max(1, min(num_workers,
                               int((mp.cpu_count()-1)/2)))
 
-        print('SketchStream using ', num_workers, 'workers')
+        # get the pool of workers, starting it only if needed
+        if (self.pool is not None
+                and (self.pool.num_workers != num_workers
+                     or not self.pool.alive())):
+            self.pool.close()
+            self.pool = None
+        if self.pool is None:
+            print('SketchStream using ', num_workers, 'workers')
+            self.pool = SketchPool(self, num_workers)
+            atexit.register(self.close)
+
         # now create a queue with a maxsize corresponding to a few times
-        # the number of workers
-        self.queue = mp.Queue(maxsize=2*num_workers)
-        manager = mp.Manager()
+        # the number of workers. If the shape of the sketches is known, it
+        # is a ring of shared tensors, so that sketches are not pickled.
+        # Otherwise, this is the queue of the pool, seen for this stream
+        # only.
+        self.pool.generation += 1
+        sketch_shape = self.sketch_shape(modules)
+        if sketch_shape is None:
+            self.queue = PoolResults(self.pool.results, self.pool.generation)
+        else:
+            self.queue = SketchRing(slots=2*num_workers, shape=sketch_shape,
+                                    condition=self.pool.condition)
 
-        # prepare some data for the synchronization of the workers
-        self.shared_data = manager.dict()
-        self.shared_data['num_epochs'] = num_epochs
+        # prepare the schedule of the workers, and their shared state
         if max_id is None:
-            self.shared_data['max_id'] = (
-                len(modules) if not isinstance(modules, ModulesDataset)
-                else torch.iinfo(torch.int16).max
-            )
-        else:
-            self.shared_data['max_id'] = max_id
-        self.shared_data['pause'] = False
-        self.shared_data['current_pick_epoch'] = 0
-        self.shared_data['current_put_epoch'] = 0
-        self.shared_data['current_sketch'] = 0
-        self.shared_data['done_in_current_epoch'] = 0
-        self.shared_data['num_sketches'] = (num_sketches if num_sketches > 0
-                                            else -1)
-        self.shared_data['sketch_list'] = (
-            None if num_sketches == -1
-            else torch.randint(
-                low=0,
-                high=self.shared_data['max_id'],
-                size=(self.shared_data['num_sketches'],)).int())
-        self.lock = mp.Lock()
-
-        # prepare the workers
-        processes = [mp.Process(target=sketch_worker,
-                                kwargs={'sketcher': self,
-                                        'modules': modules})
-                     for n in range(num_workers)]
-        #
-        # atexit.register(partial(exit_handler, stream=self,
-        #                         processes=processes))
+            max_id = (len(modules) if not isinstance(modules, ModulesDataset)
+                      else torch.iinfo(torch.int16).max)
+        if seed is None:
+            seed = torch.randint(low=0, high=2**31, size=(1,)).item()
+        self.schedule = {'num_sketches': (num_sketches if num_sketches > 0
+                                          else -1),
+                         'num_epochs': num_epochs,
+                         'max_id': max_id,
+                         'seed': seed,
+                         'num_workers': num_workers,
+                         'ordered': ordered}
+        self.state = StreamState(condition=self.pool.condition)
 
         # go
-        for p in processes:
-            p.start()
-
+        self.pool.submit({'modules': modules,
+                          'schedule': self.schedule,
+                          'state': self.state,
+                          'ring': (self.queue
+                                   if isinstance(self.queue, SketchRing)
+                                   else None),
+                          'percentiles': self.percentiles,
+                          'num_examples': self.num_examples,
+                          'error': self.error,
+                          'max_memory': self.max_memory})
         return self.queue
 
+    start = stream
+
+    def join(self, timeout=None):
+        """waits until the workers are done with the stream, which only
+        happens for a finite number of sketches. Returns whether they are."""
+        if self.state is None:
+            return True
+        return self.state.wait_for(self._finished, timeout)
+
+    def _finished(self):
+        return (self.state[StreamState.FINISHED]
+                == self.schedule['num_workers'])
+
     def pause(self):
-        if self.shared_data is None:
-            return
-        self.shared_data['pause'] = True
+        if self.state is not None:
+            self.state.set(StreamState.PAUSE, 1)
 
     def restart(self):
-        self.shared_data['counter'] = 0
         self.resume()
 
     def resume(self):
-        if self.shared_data is not None:
-            self.shared_data['pause'] = False
+        if self.state is not None:
+            self.state.set(StreamState.PAUSE, 0)
+
+    def stop(self, timeout=5):
+        """stops the stream: the workers are asked to stop, and the queue
+        is drained until they do. They then wait for the next stream. If they
+        do not stop within the timeout, the pool is shut down."""
+        if self.state is None:
+            return
+        self.state.set(StreamState.DIE, 1)
+        deadline = time.time() + timeout
+        while not self._finished() and time.time() < deadline:
+            drain(self.queue)
+            self.state.wait_for(self._finished, 0.1)
+        if not self._finished():
+            self.pool.close(timeout=0)
+            self.pool = None
+        drain(self.queue)
+        self.queue = None
+        self.state = None
+
+    def close(self, timeout=5):
+        """stops the stream and shuts the pool of workers down"""
+        atexit.unregister(self.close)
+        self.stop(timeout)
+        if self.pool is not None:
+            self.pool.close(timeout)
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # the pool and the current stream are not sent to the workers, they
+        # get the stream with each job
+        state = self.__dict__.copy()
+        state.update(pool=None, queue=None, state=None)
+        return state
+
+
+class SketchPool:
+    """A pool of persistent workers for computing streams of sketches.
+
+    The workers are started once with a copy of a Sketcher, and hence of its
+    data source. Each stream is then submitted as a job, giving the modules,
+    the sketching parameters, the schedule and the shared state of the
+    stream. Only these are pickled, so that starting a stream does not
+    require starting processes.
+
+    The pool has a single condition, shared by the rings and states of all
+    its streams: conditions cannot be sent to running processes.
+
+    sketcher: Sketcher
+        the sketcher whose data source is used by the workers
+    num_workers: int
+        the number of workers
+    """
+
+    def __init__(self, sketcher, num_workers):
+        self.num_workers = num_workers
+        # the number of streams submitted so far
+        self.generation = 0
+        self.condition = mp.Condition()
+        # the queue for the sketches that cannot be put in a ring
+        self.results = mp.Queue(maxsize=2*num_workers)
+        self.jobs = [mp.Queue() for n in range(num_workers)]
+        self.processes = [mp.Process(target=pool_worker,
+                                     kwargs={'sketcher': sketcher,
+                                             'jobs': jobs,
+                                             'results': self.results,
+                                             'condition': self.condition})
+                          for jobs in self.jobs]
+        for p in self.processes:
+            p.start()
+
+    def submit(self, job):
+        """submits a job to all workers, as a dict. Each worker gets it with
+        its own `worker_index`, and with the current `generation` of the
+        pool, which tags its results"""
+        for (worker_index, jobs) in enumerate(self.jobs):
+            jobs.put(dict(job, worker_index=worker_index,
+                          generation=self.generation))
+
+    def alive(self):
+        return all(p.is_alive() for p in self.processes)
+
+    def close(self, timeout=5):
+        """shuts the workers down once they are done with their job.
+        Workers that do not stop within the timeout are terminated."""
+        for jobs in self.jobs:
+            jobs.put(None)
+        deadline = time.time() + timeout
+        for p in self.processes:
+            while p.is_alive() and time.time() < deadline:
+                drain(self.results)
+                p.join(0.1)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        drain(self.results)
+        self.processes = []
+
+
+class PoolResults:
+    """The results queue of a SketchPool, as seen by one stream.
+
+    The workers put (generation, item) tuples in the queue, tagged with the
+    generation of their stream. Items of other generations are dropped when
+    reading: they are left by previous streams, whose workers may still
+    have been putting them when the queue was drained.
+
+    results: multiprocessing Queue
+        the results queue of the pool
+    generation: int
+        the generation of the stream
+    """
+
+    def __init__(self, results, generation):
+        self.results = results
+        self.generation = generation
+
+    def put(self, item, block=True, timeout=None):
+        self.results.put((self.generation, item), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.time()))
+            (generation, item) = self.results.get(block, remaining)
+            if generation == self.generation:
+                return item
+
+
+class StreamState:
+    """State of a stream of sketches, shared by its workers: flags and
+    progress counters in a shared memory tensor. Reading a single field
+    needs no lock. Changes are done with the condition acquired, and notified
+    to the workers waiting for them."""
+
+    PAUSE, DIE, PUT_EPOCH, DONE, FINISHED = range(5)
+
+    def __init__(self, condition=None):
+        self.values = torch.zeros(5, dtype=torch.int64).share_memory_()
+        self.condition = mp.Condition() if condition is None else condition
 
-    def stop(self):
-        if self.shared_data is not None:
-            self.shared_data['die'] = True
+    def attach(self, condition):
+        """sets the condition of a state received through a queue"""
+        self.condition = condition
+        return self
 
+    def __getstate__(self):
+        # the condition can only be pickled when spawning a process
+        state = self.__dict__.copy()
+        if get_spawning_popen() is None:
+            state['condition'] = None
+        return state
 
-def exit_handler(stream, processes):
+    def __getitem__(self, field):
+        return int(self.values[field])
+
+    def __setitem__(self, field, value):
+        self.values[field] = value
+
+    def set(self, field, value):
+        """sets a field and wakes up the workers waiting for a change"""
+        with self.condition:
+            self[field] = value
+            self.condition.notify_all()
+
+    def wait_for(self, predicate, timeout=None):
+        """waits until the predicate is true, and returns its value"""
+        with self.condition:
+            return self.condition.wait_for(predicate, timeout)
+
+
+def exit_handler(stream):
     print('Terminating sketchers...')
-    if stream.shared_data is not None:
-        stream.shared_data['die'] = True
-    for p in processes:
-        p.join()
+    stream.close()
     print('done')
 
 
-def sketch_worker(sketcher, modules):
+def sketch_ids(schedule, epoch):
+    """the ids of the sketches of an epoch of a stream, drawn from its seed"""
+    return philox.randint(schedule['max_id'], schedule['seed'], epoch,
+                          num=schedule['num_sketches'])[0]
+
+
+def release_data(sketcher):
+    """makes a waiting worker leave the BatchBroadcast of its data, if any,
+    so that the other consumers are not blocked. It joins it again when it
+    reads data."""
+    close = getattr(sketcher.data_iterator, 'close', None)
+    if callable(close):
+        close()
+
+
+def sketch_worker(sketcher, modules, worker_index):
     """ Actual worker for the sketch stream.
-    Will get sketch ids, get data from the data queue and put sketches in the
-    stream queue"""
-
-    @contextmanager
-    def getlock():
-        # get the lock of the sketcher to manipulate the sketch.shared_data
-        result = sketcher.lock.acquire(block=True)
-        yield result
-        if result:
-            sketcher.lock.release()
-
-    pause_displayed = False
-    while True:
-        # not dying, unless we see that later
-        worker_dying = False
-
-        if not sketcher.shared_data['pause']:
-            # not in pause
-
-            if pause_displayed:
-                # we were in pause previously. Output that we're no more
-                print('Sketch worker back from sleep')
-                pause_displayed = False
-
-            # print('sketch: trying to get lock')
-            # With the lock, so that only one worker can manipulate the
-            # counting in the stream data at the same time.
-            with getlock():
-                # get both the id to compute, and the number of the pick_epoch
-                # (the epoch we are currently asked to compute, as opposed
-                # to the put epoch, which is the epoch whose sketches we are
-                # currently putting in the queue.)
-                id = sketcher.shared_data['current_sketch']
-                if sketcher.shared_data['num_sketches'] == -1:
-                    # if there's an infinite number of sketches in this epoch,
-                    # just pick one item from the modules at random
-                    if hasattr(modules, '__len__'):
-                        max = len(modules)
-                    else:
-                        max = torch.iinfo(torch.int16).max
-                    sketch_id = torch.randint(low=0,
-                                              high=max,
-                                              size=(1,)).item()
-                else:
-                    sketch_id = sketcher.shared_data['sketch_list'][id].item()
-                epoch = sketcher.shared_data['current_pick_epoch']
-                # print('sketch: got lock, epoch %d and id %d' % (epoch, sketch_id))
-                if epoch >= sketcher.shared_data['num_epochs']:
-                    # if the picked epoch is larger than the number of epochs.
-                    # sketching is finished.
-                    # print('epoch', epoch, 'greater than the number of epochs:',
-                    #       sketcher.shared_data['num_epochs'], 'dying now.')
-                    worker_dying = True
-                else:
-                    if id == sketcher.shared_data['num_sketches'] - 1:
-                        # we reached the number of sketches per epoch.
-                        # we let the other workers know and increment the
-                        # pick epoch.
-                        # print("Obtained id %d is last for this epoch. "
-                        #       "Reseting the counter and incrementing current "
-                        #       "epoch " % id)
-                        sketcher.shared_data['current_sketch'] = 0
-                        sketcher.shared_data['current_pick_epoch'] += 1
-                        sketcher.shared_data['sketch_list'] = (
-                            torch.randint(
-                                low=0,
-                                high=sketcher.shared_data['max_id'],
-                                size=(sketcher.shared_data['num_sketches'],)
-                                ).int())
-                    else:
-                        # we just increment the current sketch to pick for
-                        # the next worker.
-                        sketcher.shared_data['current_sketch'] += 1
-            if worker_dying:
-                # dying has been asked for. we'll just loop infinitely.
-                # this is because there is apparently some issues raised when
-                # we just kill the worker, in case some data in the queue
-                # originated from him has not been taken out ?
-                # print(
-                #     id, epoch, 'Reached the desired amount of epochs. Dying.')
-                while not sketcher.queue.empty():
-                    pass
-                # HERE WE SHOULD ACTUALLY DIE. However, there seems to be
-                # an issue of the code not running (queue disappears) when
-                # we do. Hence, I will infinitely loop here. BUG TO FIX
-                while True:
-                    time.sleep(10)
-                return
-
-            # now to the thing. We compute the sketch that has been asked for.
-            # print('sketch: now trying to compute %d with id %d'
-            #       % (id, sketch_id))
+    Will compute its share of the sketches, get data from the data queue and
+    put sketches in the stream queue"""
+    state = sketcher.state
+    schedule = sketcher.schedule
+    num_sketches = schedule['num_sketches']
+
+    def put(item):
+        # put an item, unless we are asked to stop in the meantime
+        while not state[StreamState.DIE]:
+            try:
+                sketcher.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # the position of the next sketch to compute in the whole stream, and
+    # the ids of the current epoch
+    position = worker_index
+    ids = None
+    ids_epoch = None
+
+    while not state[StreamState.DIE]:
+        if state[StreamState.PAUSE]:
+            print('Sketch worker going to sleep')
+            release_data(sketcher)
+            state.wait_for(lambda: not state[StreamState.PAUSE]
+                           or state[StreamState.DIE])
+            print('Sketch worker back from sleep')
+            continue
+
+        # get both the id to compute, and the epoch it belongs to
+        if num_sketches == -1:
+            # if there's an infinite number of sketches in this epoch,
+            # just pick one item from the modules at random
+            epoch = 0
+            sketch_id = philox.randint(schedule['max_id'], schedule['seed'],
+                                       position, offset=1)[0, 0].item()
+        else:
+            (epoch, rank) = divmod(position, num_sketches)
+            if epoch >= schedule['num_epochs']:
+                # if the picked epoch is larger than the number of epochs.
+                # sketching is finished.
+                break
+            if ids_epoch != epoch:
+                ids = sketch_ids(schedule, epoch)
+                ids_epoch = epoch
+            sketch_id = ids[rank].item()
+        position += schedule['num_workers']
+
+        # now to the thing. We compute the sketch that has been asked for.
+        # check the cache first, possibly without even generating the
+        # module
+        target_qf = None
+        projectors_fingerprint = getattr(modules, 'fingerprint', None)
+        if projectors_fingerprint is not None:
+            target_qf = sketcher.lookup(
+                (projectors_fingerprint(), sketch_id))
+        if target_qf is None:
             module = modules[sketch_id]
             target_qf = sketcher[module]
 
-            # print('sketch: we computed the sketch with id', id)
+        if schedule['ordered']:
             # we need to wait until the current put epoch is the epoch we
             # picked. It may indeed happen that we are several epochs ahead.
-            can_put = False
-            while not can_put:
-                with getlock():
-                    current_put_epoch = (
-                        sketcher.shared_data['current_put_epoch'])
-                if current_put_epoch == epoch:
-                    can_put = True
-                else:
-                    if 'die' in sketcher.shared_data:
-                        # print('Sketch worker dying wait for put')
-                        while True:
-                            # see line 388
-                            time.sleep(10)
-                        return
-                    time.sleep(1)
-
-            # print('sketch: trying to put id', id, 'epoch', epoch)
-            # now we actually put the sketch in the queue.
-            sketcher.queue.put((target_qf.detach(), sketch_id))
-            # print('sketch: we put id', id, 'epoch', epoch)
-
-            with getlock():
-                # we put the data, now update the counting
-                sketcher.shared_data['done_in_current_epoch'] += 1
-                # print('sketch: after put, got lock. id', id, 'epoch', epoch, 'done in current epoch',sketcher.shared_data['done_in_current_epoch'])
-                if (sketcher.shared_data['done_in_current_epoch']
-                        == sketcher.shared_data['num_sketches']):
-                    # This item was the last of its epoch, we put the sentinel
-                    # print('Sketch: sending the sentinel')
-                    sketcher.queue.put(None)
-                    sketcher.shared_data['done_in_current_epoch'] = 0
-                    sketcher.shared_data['current_put_epoch'] += 1
-
-        if 'die' in sketcher.shared_data:
-            # print('Sketch worker dying')
-            while True:
-                # see line 388
-                time.sleep(10)
+            # We are woken up when it changes.
+            if state[StreamState.PUT_EPOCH] != epoch:
+                release_data(sketcher)
+            state.wait_for(lambda: state[StreamState.PUT_EPOCH] == epoch
+                           or state[StreamState.DIE])
+            if state[StreamState.DIE]:
+                break
+
+        # now we actually put the sketch in the queue.
+        if not put((target_qf.detach(), sketch_id)):
             break
 
-        if sketcher.shared_data['pause']:
-            if not pause_displayed:
-                print('Sketch worker going to sleep')
-                pause_displayed = True
-            time.sleep(2)
+        if num_sketches == -1:
+            continue
+        with state.condition:
+            # we put the data, now update the counting
+            state[StreamState.DONE] += 1
+            last = (state[StreamState.DONE]
+                    == (num_sketches if schedule['ordered']
+                        else num_sketches * schedule['num_epochs']))
+        if not last:
+            continue
+        # the sentinel is put without holding the condition, which is needed
+        # by `stop` to ask the workers to die while the queue is full
+        put(None)
+        if schedule['ordered']:
+            # This item was the last of its epoch: no other worker puts
+            # anything until we wake up the ones waiting for the next epoch
+            with state.condition:
+                state[StreamState.DONE] = 0
+                state[StreamState.PUT_EPOCH] += 1
+                state.condition.notify_all()
+
+
+def pool_worker(sketcher, jobs, results, condition):
+    """Persistent worker of a SketchPool. Runs the jobs it gets from its
+    queue with `sketch_worker`, until it gets None. Since the worker stays
+    alive, sketches put in the results queue remain valid after each job."""
+    # a forked worker inherits the random generator and subscription of the
+    # data iterator of its parent, which must not be shared
+    reset = getattr(sketcher.data_iterator, 'reset', None)
+    if callable(reset):
+        reset()
+    for job in iter(jobs.get, None):
+        sketcher.state = job['state'].attach(condition)
+        sketcher.queue = (PoolResults(results, job['generation'])
+                          if job['ring'] is None
+                          else job['ring'].attach(condition))
+        sketcher.schedule = job['schedule']
+        sketcher.percentiles = job['percentiles']
+        sketcher.num_examples = job['num_examples']
+        sketcher.error = job['error']
+        sketcher.max_memory = job['max_memory']
+        try:
+            sketch_worker(sketcher, job['modules'], job['worker_index'])
+        finally:
+            release_data(sketcher)
+            with condition:
+                sketcher.state[StreamState.FINISHED] += 1
+                condition.notify_all()
 
 
 def add_sketch_arguments(parser):
@@ -440,6 +942,11 @@ def add_sketch_arguments(parser):
                              "negative, take all of them.",
                         type=int,
                         default=3000)
+    parser.add_argument("--sketch_error",
+                        help="Normalized rank error of the streaming quantile "
+                             "summaries. If not provided, sketches are exact.",
+                        type=float,
+                        default=None)
     parser.add_argument("--num_sketches",
                         help="Number of sketches per epoch. If negative, "
                              "take an infinite number of them.",
@@ -0,0 +1,177 @@
+import torch
+from math import ceil
+from torchpercentile import Percentile
+from torchsearchsorted import searchsorted
+
+
+def all_ranks(percentiles, num_samples):
+    """checks whether some percentiles are the ones of all the ranks of
+    num_samples samples, i.e. linspace(0, 100, num_samples). The quantiles
+    are then the sorted samples, without any interpolation."""
+    percentiles = torch.as_tensor(percentiles)
+    if percentiles.dim() != 1 or len(percentiles) != num_samples:
+        return False
+    ranks = torch.linspace(0, 100, num_samples, dtype=torch.float64)
+    return bool(torch.allclose(percentiles.detach().cpu().double(), ranks))
+
+
+class QuantileSummary:
+    """Streaming and mergeable quantile summary of the columns of a matrix.
+
+    This is a KLL-like summary: samples are gathered in a hierarchy of
+    compactors, where level h holds items of weight 2**h. Whenever a level is
+    full, it is sorted and every other item is promoted to the next level.
+    Whether the items of even or odd rank are promoted is drawn at random
+    for each compaction, so that the errors of the compactions cancel out
+    instead of adding up. Since all columns of the data always receive the
+    same number of samples, the compactors and their random choices are
+    shared by all columns and all operations are vectorized over them.
+
+    As long as no compaction occurred, the summary is exact and the quantiles
+    are computed with `Percentile` on the raw samples, so that gradients
+    flow through it.
+
+    error: float or None
+        the desired normalized rank error of the quantiles. If None, the
+        summary never compacts and is exact, with memory growing with the
+        number of samples. Otherwise, the memory is O(1/error) per column,
+        whatever the number of samples.
+    seed: int
+        the seed of the random generator of the summary, so that it is
+        deterministic for the same data.
+    """
+
+    def __init__(self, error=None, seed=0):
+        self.error = error
+        # capacity of the top compactor. With this capacity, the maximal
+        # rank error over all quantiles was found to stay below the error
+        # for millions of samples
+        self.k = None if error is None else max(8, int(ceil(4. / error)))
+        # the compactors. Level 0 is kept as a list of chunks to avoid copies
+        # before the first compaction.
+        self.pending = []
+        self.num_pending = 0
+        self.levels = []
+        # the generator for the parity of the compactions
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        # total weight in the summary
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def exact(self):
+        """whether the summary still holds all the samples"""
+        return not self.levels
+
+    def capacity(self, level):
+        """capacity of the compactor at a given level: the top ones have
+        capacity k, the lower ones have geometrically decreasing capacities"""
+        height = max(len(self.levels), level + 1)
+        return max(2, int(ceil(self.k * (2. / 3.) ** (height - 1 - level))))
+
+    def update(self, data):
+        """add a batch of samples to the summary.
+
+        data: Tensor (num_samples,) + shape
+            each sample is flattened, each of its entries is a column of the
+            summary
+        """
+        if not len(data):
+            return self
+        data = data.view(data.shape[0], -1)
+        self.pending += [data, ]
+        self.num_pending += data.shape[0]
+        self.count += data.shape[0]
+        if self.k is not None and self.num_pending >= self.capacity(0):
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """merge another summary into this one. Both summaries must have
+        been fed with samples of the same dimension"""
+        # the merged summary is only exact if both are
+        if self.k is None or (other.k is not None and other.k > self.k):
+            self.k, self.error = other.k, other.error
+        self.pending += other.pending
+        self.num_pending += other.num_pending
+        self.count += other.count
+        for level, items in enumerate(other.levels):
+            if level >= len(self.levels):
+                self.levels += [items[:0], ]
+            self.levels[level] = torch.cat((self.levels[level], items))
+        if self.k is not None:
+            self._compress()
+        return self
+
+    def _compress(self):
+        # moving the pending chunks to level 0
+        if self.pending:
+            chunks = self.pending
+            if self.levels:
+                chunks = [self.levels[0], ] + chunks
+            else:
+                self.levels = [None, ]
+            self.levels[0] = torch.cat(chunks).detach()
+            self.pending = []
+            self.num_pending = 0
+
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.shape[0] < self.capacity(level):
+                level += 1
+                continue
+            # put an item aside if the number of items is odd, so that the
+            # total weight is preserved
+            kept = items[:items.shape[0] % 2]
+            items = torch.sort(items[kept.shape[0]:], dim=0)[0]
+            offset = int(torch.randint(2, (1,), generator=self.generator))
+            promoted = items[offset::2]
+            self.levels[level] = kept
+            if level + 1 == len(self.levels):
+                self.levels += [promoted, ]
+            else:
+                self.levels[level + 1] = torch.cat(
+                    (self.levels[level + 1], promoted))
+            level += 1
+
+    def quantiles(self, percentiles):
+        """compute the quantiles of the columns of the summary.
+
+        percentiles: Tensor (num_percentiles,)
+            the percentiles, between 0 and 100
+
+        returns a Tensor (num_percentiles, num_columns)"""
+        if not self.count:
+            raise Exception('QuantileSummary: no data, cannot compute '
+                            'quantiles.')
+        if self.exact:
+            data = torch.cat(self.pending)
+            if all_ranks(percentiles, data.shape[0]):
+                # the quantiles are the sorted samples, the backward of the
+                # sort just scatters the gradients with its indices
+                return torch.sort(data, dim=0)[0]
+            return Percentile()(data, percentiles)
+
+        self._compress()
+        values = torch.cat(self.levels)
+        weights = torch.cat(
+            [torch.full((len(items),), float(2 ** level),
+                        device=values.device)
+             for level, items in enumerate(self.levels)])
+
+        # sort each column and cumulate the weights of its items
+        values, indices = torch.sort(values, dim=0)
+        ranks = torch.cumsum(weights[indices], dim=0)
+
+        # for each percentile, pick the first item whose rank is above it
+        percentiles = torch.as_tensor(percentiles, device=values.device)
+        targets = (percentiles.float() / 100. * self.count).clamp(min=1)
+        indices = searchsorted(
+            ranks.t().contiguous(),
+            targets[None, :].expand(values.shape[1], -1).contiguous())
+        indices = indices.long().clamp(max=values.shape[0] - 1)
+        return torch.gather(values.t(), 1, indices).t()
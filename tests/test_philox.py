@@ -0,0 +1,36 @@
+import torch
+from qsketch import philox
+
+
+def words(*values):
+    return tuple(torch.tensor(value, dtype=torch.int64) for value in values)
+
+
+def test_known_answers():
+    # Philox4x32-10 known answer vectors of the Random123 library
+    vectors = [
+        ((0, 0, 0, 0), (0, 0),
+         (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+        ((0xffffffff,) * 4, (0xffffffff,) * 2,
+         (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+        ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344),
+         (0xa4093822, 0x299f31d0),
+         (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1)),
+    ]
+    for (counter, key, expected) in vectors:
+        result = philox.philox(words(*counter), words(*key))
+        assert tuple(int(word) for word in result) == expected
+
+
+def test_indexes_are_independent_calls():
+    # generating several indexes at once gives the same numbers as one by one
+    together = philox.normal((3, 5), seed=7, indexes=[0, 4, 9])
+    for (rank, index) in enumerate([0, 4, 9]):
+        alone = philox.normal((3, 5), seed=7, indexes=index)[0]
+        assert torch.equal(together[rank], alone)
+
+
+def test_global_state_untouched():
+    state = torch.get_rng_state()
+    philox.uniform((100,), seed=3, indexes=list(range(10)))
+    assert torch.equal(torch.get_rng_state(), state)
@@ -0,0 +1,53 @@
+import pytest
+import torch
+from qsketch import ModulesDataset, LinearProjector, sw
+from qsketch.sketch import sketch
+
+
+def samples(num_samples, shape, seed=0):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return torch.randn((num_samples,) + shape, generator=generator)
+
+
+def test_chunked_sketch_is_unchanged():
+    # sketching by chunks of outputs gives the same quantiles
+    data = samples(500, (3, 4))
+    modules = ModulesDataset(LinearProjector, input_shape=(3, 4),
+                             num_projections=20)(range(4))
+    percentiles = torch.linspace(0, 100, 50)
+    whole = sketch(modules, data, percentiles, fused=True)
+    chunked = sketch(modules, data, percentiles, fused=True,
+                     max_memory=2**14)
+    for (expected, result) in zip(whole, chunked):
+        assert torch.allclose(expected, result, atol=1e-6)
+
+
+def test_chunked_sketch_rejects_streaming():
+    # chunking keeps all data, which streaming summaries are meant to avoid
+    module = LinearProjector((3, 4), 20, key=(0, 0))
+    with pytest.raises(Exception):
+        sketch(module, samples(500, (3, 4)), torch.linspace(0, 100, 50),
+               error=0.01, max_memory=2**14)
+
+
+def test_chunked_sw_is_unchanged():
+    # with the same seed, chunks of projections give the same distance
+    (batch1, batch2) = (samples(300, (10,), seed=0),
+                        samples(200, (10,), seed=1))
+    whole = sw(batch1, batch2, num_projections=100, seed=3)
+    chunked = sw(batch1, batch2, num_projections=100, seed=3,
+                 max_memory=2**15)
+    assert torch.allclose(whole, chunked, rtol=1e-5)
+
+
+def test_bank_matches_modules():
+    # a bank generated at once has the weights of the modules one by one
+    dataset = ModulesDataset(LinearProjector, seed=5, input_shape=(3, 4),
+                             num_projections=6)
+    indexes = [0, 3, 11]
+    bank = dataset.bank(indexes)
+    weights = torch.stack([module.weight for module in dataset(indexes)])
+    assert torch.equal(bank.weight.view(weights.shape), weights)
+    assert torch.equal(
+        LinearProjector.random_weights(indexes, (3, 4), 6, seed=5), weights)
@@ -0,0 +1,34 @@
+import torch
+from qsketch.summary import QuantileSummary
+
+
+def max_rank_error(num_samples, error, batch_size=600):
+    """the maximal normalized rank error of the quantiles of a summary of
+    shuffled integers, whose values are hence their ranks"""
+    generator = torch.Generator()
+    generator.manual_seed(0)
+    data = torch.randperm(num_samples, generator=generator).float()
+    summary = QuantileSummary(error=error)
+    for start in range(0, num_samples, batch_size):
+        summary.update(data[start:start + batch_size, None])
+    assert not summary.exact
+    percentiles = torch.linspace(0.1, 99.9, 999)
+    quantiles = summary.quantiles(percentiles)[:, 0].double()
+    ranks = (quantiles + 1.) / num_samples
+    return (ranks - percentiles.double() / 100.).abs().max().item()
+
+
+def test_error_bound():
+    for error in (0.01, 0.05):
+        assert max_rank_error(10 ** 6, error) <= error
+
+
+def test_exact():
+    data = torch.randn(1000, 3)
+    summary = QuantileSummary()
+    for start in range(0, 1000, 100):
+        summary.update(data[start:start + 100])
+    assert summary.exact
+    percentiles = torch.linspace(0, 100, 1000)
+    assert torch.equal(summary.quantiles(percentiles),
+                       torch.sort(data, dim=0)[0])